@@ -1,15 +1,24 @@
-from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 from langchain_groq import ChatGroq
 import os
+import time
 from dotenv import load_dotenv
 
+from llm_cache import response_cache, prompt_key
+from llm_metrics import llm_metrics, estimate_tokens, trim_to_tokens
+from llm_scheduler import llm_scheduler, Priority
+from workout_plan import WorkoutPlan, SECTION_TITLES, parse_section
+
 load_dotenv()
 
+LLM_MODEL = "llama-3.1-8b-instant"
+
 llm = ChatGroq(
     api_key=os.getenv("GROQ_API_KEY"),
-    model="llama-3.1-8b-instant",
+    model=LLM_MODEL,
     temperature=0.5,
     max_tokens=1000,  # Увеличил для более детальных планов
+    max_retries=0,  # Повторы после 429 выполняет llm_scheduler
 )
 
 SYSTEM_PROMPT = (
@@ -27,23 +36,158 @@ FITNESS_LEVELS = {
 }
 
 
+#Сколько токенов ответа резервировать в лимите TPM до получения фактического числа
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "500"))
+
+#Бюджеты токенов: на подставляемый в промпт контекст (анализ прогресса) и на весь промпт чата
+PROMPT_CONTEXT_TOKEN_BUDGET = int(os.getenv("PROMPT_CONTEXT_TOKEN_BUDGET", "300"))
+CHAT_PROMPT_TOKEN_BUDGET = int(os.getenv("CHAT_PROMPT_TOKEN_BUDGET", "2500"))
+
+
+def _prompt_tokens(messages: list) -> int:
+    return sum(estimate_tokens(message.content) for message in messages)
+
+
+#Фактическое использование токенов из ответа, если провайдер его вернул
+def _usage(response, prompt_tokens: int) -> tuple[int, int]:
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        return usage.get("input_tokens", prompt_tokens), usage.get("output_tokens", 0)
+    return prompt_tokens, estimate_tokens(response.content)
+
+
+#Ключ кэша для детерминированных промптов (None — ответ не кэшируется)
+def _cache_key(messages: list, cacheable: bool):
+    if not cacheable or response_cache is None:
+        return None
+    return prompt_key(LLM_MODEL, *(message.content for message in messages))
+
+
 # Вызов LLM
-def _invoke_llm(messages: list, use_system_prompt: bool = True):
+async def _invoke_llm(messages: list, use_system_prompt: bool = True, cacheable: bool = False, name: str = "llm",
+                      priority: int = Priority.PLAN):
+    """
+    Асинхронный вызов LLM: не блокирует цикл событий бота во время генерации.
+    cacheable=True — ответ берётся из кэша, если такой же промпт уже генерировался.
+    name — имя функции агента для метрик токенов и задержек.
+    priority — класс очереди llm_scheduler (регистрация обслуживается раньше чата).
+    """
     if use_system_prompt:
         messages.insert(0, SystemMessage(content=SYSTEM_PROMPT))
-    response = llm.invoke(messages)
+    started = time.monotonic()
+
+    key = _cache_key(messages, cacheable)
+    if key:
+        cached = await response_cache.get(key)
+        if cached is not None:
+            llm_metrics.record(name, 0, 0, time.monotonic() - started, cached=True)
+            return cached
+
+    estimated_prompt = _prompt_tokens(messages)
+    attempt = 0
+    while True:
+        try:
+            async with llm_scheduler.slot(priority, estimated_prompt + LLM_EXPECTED_COMPLETION_TOKENS) as entry:
+                response = await llm.ainvoke(messages)
+                prompt_tokens, completion_tokens = _usage(response, estimated_prompt)
+                #Уточняем расход токенов в окне лимита TPM
+                entry[1] = prompt_tokens + completion_tokens
+            break
+        except Exception as e:
+            if not await llm_scheduler.backoff(e, attempt):
+                raise
+            attempt += 1
+
+    llm_metrics.record(name, prompt_tokens, completion_tokens, time.monotonic() - started)
+
+    if key:
+        await response_cache.add(key, response.content)
     return response.content
 
 
-# Генерация дневной тренировки
-def generate_daily_workout(user_data: dict) -> str:
+# Потоковый вызов LLM
+async def _stream_llm(messages: list, use_system_prompt: bool = True, cacheable: bool = False, name: str = "llm",
+                      priority: int = Priority.PLAN):
     """
-    Генерирует одну часовую тренировку на день.
-    Объединяет упражнения на разные группы мышц в одну сессию.
+    Отдаёт текст ответа частями по мере генерации.
+    Закэшированный ответ отдаётся одной порцией.
     """
+    if use_system_prompt:
+        messages.insert(0, SystemMessage(content=SYSTEM_PROMPT))
+    started = time.monotonic()
+
+    key = _cache_key(messages, cacheable)
+    if key:
+        cached = await response_cache.get(key)
+        if cached is not None:
+            llm_metrics.record(name, 0, 0, time.monotonic() - started, cached=True)
+            yield cached
+            return
+
+    estimated_prompt = _prompt_tokens(messages)
+    parts = []
+    attempt = 0
+    while True:
+        try:
+            async with llm_scheduler.slot(priority, estimated_prompt + LLM_EXPECTED_COMPLETION_TOKENS) as entry:
+                async for chunk in llm.astream(messages):
+                    if chunk.content:
+                        parts.append(chunk.content)
+                        yield chunk.content
+                entry[1] = estimated_prompt + estimate_tokens("".join(parts))
+            break
+        except Exception as e:
+            #Повторять можно, только пока пользователю ещё ничего не отдано
+            if parts or not await llm_scheduler.backoff(e, attempt):
+                raise
+            attempt += 1
+
+    text = "".join(parts)
+    llm_metrics.record(name, estimated_prompt, estimate_tokens(text), time.monotonic() - started)
+
+    if key:
+        await response_cache.add(key, text)
+
+
+#Формат ответа с планом тренировки — его разбирает workout_plan.parse_plan
+PLAN_FORMAT = """**Формат ответа:**
+Название тренировки
+
+**Разминка:**
+- Упражнение 1
+- Упражнение 2
+
+**Основная часть:**
+1. Упражнение (группа мышц) - 3x10-15
+2. Упражнение (группа мышц) - 3x10-15
+...
+
+**Заминка:**
+- Упражнение 1
+- Упражнение 2
+
+**Рекомендации по питанию на день:**
+- Белки: ...
+- Углеводы: ...
+- Жиры: ...
+- Калории: ...
+- Пример приемов пищи"""
+
+#Формат ответа при перегенерации одного раздела плана
+SECTION_FORMATS = {
+    "warmup": "- Упражнение 1\n- Упражнение 2",
+    "exercises": "1. Упражнение (группа мышц) - 3x10-15\n2. Упражнение (группа мышц) - 3x10-15\n...",
+    "cooldown": "- Упражнение 1\n- Упражнение 2",
+    "nutrition": "- Белки: ...\n- Углеводы: ...\n- Жиры: ...\n- Калории: ...\n- Пример приемов пищи",
+}
+
+
+#Промпт дневной тренировки
+def _daily_workout_prompt(user_data: dict) -> str:
     goal = user_data["goal"]
-    height = user_data["height"]
-    weight = user_data["weight"]
+    #Округление делает промпт общим для похожих пользователей и повышает попадания в кэш
+    height = round(user_data["height"])
+    weight = round(user_data["weight"])
     level = user_data.get("level", "новичок")
     coaching_mode = user_data.get("coaching_mode", "level1")
 
@@ -70,45 +214,45 @@ def generate_daily_workout(user_data: dict) -> str:
 - Включи упражнения на: грудь, спину, ноги, пресс
 - Добавь 1-2 кардио-упражнения если цель - похудение
 
-**Формат ответа:**
-Название тренировки
+{PLAN_FORMAT}
 
-**Разминка:**
-- Упражнение 1
-- Упражнение 2
+Перед началом программы проконсультируйтесь с врачом, если есть хронические заболевания."""
 
-**Основная часть:**
-1. Упражнение (группа мышц) - 3x10-15
-2. Упражнение (группа мышц) - 3x10-15
-...
+    return prompt
 
-**Заминка:**
-- Упражнение 1
-- Упражнение 2
 
-**Рекомендации по питанию на день:**
-- Белки: ...
-- Углеводы: ...
-- Жиры: ...
-- Калории: ...
-- Пример приемов пищи
+# Генерация дневной тренировки
+async def generate_daily_workout(user_data: dict, priority: int = Priority.PLAN) -> str:
+    """
+    Генерирует одну часовую тренировку на день.
+    Объединяет упражнения на разные группы мышц в одну сессию.
+    """
+    messages = [HumanMessage(content=_daily_workout_prompt(user_data))]
+    return await _invoke_llm(messages, use_system_prompt=True, cacheable=True, name="generate_daily_workout",
+                             priority=priority)
 
-Перед началом программы проконсультируйтесь с врачом, если есть хронические заболевания."""
 
-    messages = [HumanMessage(content=prompt)]
-    return _invoke_llm(messages, use_system_prompt=True)
+# Потоковая генерация дневной тренировки
+async def stream_daily_workout(user_data: dict, priority: int = Priority.PLAN):
+    """
+    То же, что generate_daily_workout, но отдаёт текст частями.
+    """
+    messages = [HumanMessage(content=_daily_workout_prompt(user_data))]
+    async for chunk in _stream_llm(messages, use_system_prompt=True, cacheable=True, name="stream_daily_workout",
+                                 priority=priority):
+        yield chunk
 
 
 #Генерация плана старая версия - оставляем для обратной совместимости
-def generate_plan(user_data: dict) -> str:
+async def generate_plan(user_data: dict) -> str:
     """
     Основная функция генерации плана.
     Для новичков генерирует дневную тренировку, для других уровней - более сложные планы.
     """
     coaching_mode = user_data.get("coaching_mode", "level1")
     goal = user_data["goal"]
-    height = user_data["height"]
-    weight = user_data["weight"]
+    height = round(user_data["height"])
+    weight = round(user_data["weight"])
     level = user_data.get("level", "новичок")
 
     if coaching_mode == "level3":
@@ -132,17 +276,16 @@ def generate_plan(user_data: dict) -> str:
 
     else:  # level1 - новичок
         # Используем новую функцию для генерации дневной тренировки
-        return generate_daily_workout(user_data)
+        return await generate_daily_workout(user_data, priority=Priority.PLAN)
 
     messages = [HumanMessage(content=prompt)]
-    return _invoke_llm(messages, use_system_prompt=True)
+    return await _invoke_llm(messages, use_system_prompt=True, cacheable=True, name="generate_plan", priority=Priority.PLAN)
 
 
-#Генерация нового плана на день
-def generate_new_day_plan(user_data: dict, streak: int, previous_progress: str = "") -> str:
-    """
-    Генерирует новый план на день с учетом прогресса и серии тренировок.
-    """
+#Промпт нового плана на день
+def _new_day_plan_prompt(user_data: dict, streak: int, previous_progress: str = "") -> str:
+    #Подставляемый анализ прогресса не должен раздувать промпт
+    previous_progress = trim_to_tokens(previous_progress, PROMPT_CONTEXT_TOKEN_BUDGET)
     goal = user_data["goal"]
     height = user_data["height"]
     weight = user_data["weight"]
@@ -182,19 +325,66 @@ def generate_new_day_plan(user_data: dict, streak: int, previous_progress: str =
 2. Если цель - набор массы: акцент на базовые упражнения
 3. Если цель - поддержание формы: сбалансированный подход
 
+{PLAN_FORMAT}
+
 Перед началом программы проконсультируйтесь с врачом, если есть хронические заболевания."""
 
+    return prompt
+
+
+#Генерация нового плана на день
+async def generate_new_day_plan(user_data: dict, streak: int, previous_progress: str = "") -> str:
+    """
+    Генерирует новый план на день с учетом прогресса и серии тренировок.
+    """
+    messages = [HumanMessage(content=_new_day_plan_prompt(user_data, streak, previous_progress))]
+    return await _invoke_llm(messages, use_system_prompt=True, name="generate_new_day_plan", priority=Priority.PLAN)
+
+
+#Потоковая генерация нового плана на день
+async def stream_new_day_plan(user_data: dict, streak: int, previous_progress: str = ""):
+    """
+    То же, что generate_new_day_plan, но отдаёт текст частями.
+    """
+    messages = [HumanMessage(content=_new_day_plan_prompt(user_data, streak, previous_progress))]
+    async for chunk in _stream_llm(messages, use_system_prompt=True, name="stream_new_day_plan",
+                                 priority=Priority.PLAN):
+        yield chunk
+
+
+#Перегенерация одного раздела плана
+async def regenerate_plan_section(user_data: dict, plan: WorkoutPlan, section: str = "exercises",
+                                  priority: int = Priority.PLAN) -> WorkoutPlan | None:
+    """
+    Составляет заново только раздел section (warmup, exercises, cooldown, nutrition),
+    остальные разделы берутся из plan. None — ответ не удалось разобрать.
+    """
+    title = SECTION_TITLES[section]
+    prompt = f"""Пользователь: {round(user_data["height"])} см, {round(user_data["weight"])} кг, цель: {user_data["goal"]}.
+
+Текущая тренировка:
+{plan.render(as_html=False)}
+
+Составь заново только раздел «{title}»: другие упражнения или их вариации, та же продолжительность и нагрузка.
+Остальные разделы не меняются. Ответь только этим разделом в формате:
+
+**{title}:**
+{SECTION_FORMATS[section]}"""
+
     messages = [HumanMessage(content=prompt)]
-    return _invoke_llm(messages, use_system_prompt=True)
+    response = await _invoke_llm(messages, use_system_prompt=True, name="regenerate_plan_section", priority=priority)
+    fresh = parse_section(response, section)
+    return plan.with_section(section, fresh) if fresh else None
 
 
-# Анализ прогресса
-def analyze_progress(user_data: dict, progress: list, workout_logs: list = None) -> str:
+# Локальная сводка прогресса (без LLM)
+def summarize_progress(user_data: dict, progress: list, workout_logs: list = None) -> str:
     """
-    Анализирует прогресс пользователя и дает рекомендации.
+    Считает сводку прогресса по правилам, без обращения к LLM.
+    Используется как контекст для плана и мотивации, пока идёт развернутый анализ.
     """
     if not progress:
-        return "Пока недостаточно данных для анализа. Продолжайте тренировки и обновляйте вес регулярно!"
+        return ""
 
     # Анализ веса
     init_weight = progress[0][0]
@@ -205,8 +395,8 @@ def analyze_progress(user_data: dict, progress: list, workout_logs: list = None)
     # Анализ тренировок
     workout_count = len(workout_logs) if workout_logs else 0
     if workout_logs and len(workout_logs) > 1:
-        first_date = min(log[1] for log in workout_logs)
-        last_date = max(log[1] for log in workout_logs)
+        first_date = min(log[0] for log in workout_logs)
+        last_date = max(log[0] for log in workout_logs)
         days_active = (last_date - first_date).days + 1
         consistency = workout_count / max(days_active, 1)
     else:
@@ -263,40 +453,89 @@ def analyze_progress(user_data: dict, progress: list, workout_logs: list = None)
 
         analysis += f"\n\nТренировок выполнено: {workout_count}. {consistency_text}"
 
-    # Генерация финального промпта для ИИ
-    prompt = f"""Начальный вес: {init_weight} кг
+    return f"""Начальный вес: {init_weight} кг
 Текущий вес: {current_weight} кг
 Изменение: {diff:.1f} кг
 Цель: {goal}
 Анализ: {analysis}
-Рекомендация: {recommendation}
+Рекомендация: {recommendation}"""
+
+
+# Анализ прогресса
+async def analyze_progress(user_data: dict, progress: list, workout_logs: list = None) -> str:
+    """
+    Анализирует прогресс пользователя и дает рекомендации.
+    """
+    if not progress:
+        return "Пока недостаточно данных для анализа. Продолжайте тренировки и обновляйте вес регулярно!"
+
+    # Генерация финального промпта для ИИ
+    summary = summarize_progress(user_data, progress, workout_logs)
+    prompt = f"""{summary}
 
 Дайте развернутый комментарий и конкретные рекомендации на следующие 7 дней."""
 
     messages = [HumanMessage(content=prompt)]
-    return _invoke_llm(messages, use_system_prompt=True)
+    return await _invoke_llm(messages, use_system_prompt=True, name="analyze_progress", priority=Priority.PLAN)
 
 
 #Обычный чат с ИИ
-def chat_with_ai(user_message: str, context: dict = None) -> str:
+async def chat_with_ai(user_message: str, context: dict = None, history: list = None, summary: str = "") -> str:
     """
     Общение с пользователем с возможностью контекста.
+    history — последние реплики [(role, content), ...], role: 'user' или 'assistant';
+    summary — сжатое содержание более ранней части разговора.
     """
-    messages = [HumanMessage(content=user_message)]
+    messages = []
 
     # Если есть контекст, добавляем его
     if context:
         context_message = f"Контекст: Пользователь тренируется {context.get('streak', 0)} дней, цель: {context.get('goal', 'не указана')}."
-        messages.insert(0, HumanMessage(content=context_message))
+        messages.append(HumanMessage(content=context_message))
+
+    if summary:
+        messages.append(HumanMessage(content=f"Краткое содержание предыдущего разговора: {summary}"))
+
+    #Если промпт не укладывается в бюджет, отбрасываем самые старые реплики истории
+    history = list(history or [])
+    fixed_tokens = _prompt_tokens(messages) + estimate_tokens(user_message)
+    while history and fixed_tokens + sum(estimate_tokens(content) for _, content in history) > CHAT_PROMPT_TOKEN_BUDGET:
+        history.pop(0)
+
+    for role, content in history:
+        messages.append(AIMessage(content=content) if role == "assistant" else HumanMessage(content=content))
+
+    messages.append(HumanMessage(content=user_message))
+    return await _invoke_llm(messages, use_system_prompt=False, name="chat_with_ai", priority=Priority.CHAT)
 
-    return _invoke_llm(messages, use_system_prompt=False)
+
+#Сжатие старой части разговора
+async def summarize_conversation(previous_summary: str, turns: list) -> str:
+    """
+    Сворачивает старые реплики (и прежнее резюме) в короткое резюме для памяти чата.
+    """
+    dialog = "\n".join(
+        f"{'Тренер' if role == 'assistant' else 'Пользователь'}: {content}" for role, content in turns
+    )
+    prompt = f"""{f"Прежнее резюме: {previous_summary}" if previous_summary else ""}
+
+Диалог:
+{dialog}
+
+Сожми разговор в резюме до 5 предложений: цели, ограничения, самочувствие,
+договорённости и важные факты о пользователе. Только факты, без оценок."""
+
+    messages = [HumanMessage(content=prompt)]
+    return await _invoke_llm(messages, use_system_prompt=False, name="summarize_conversation",
+                             priority=Priority.BACKGROUND)
 
 
 #Генерация мотивационного сообщения
-def generate_motivation(streak: int, goal: str, recent_progress: str = "") -> str:
+async def generate_motivation(streak: int, goal: str, recent_progress: str = "") -> str:
     """
     Генерирует мотивационное сообщение на основе серии тренировок.
     """
+    recent_progress = trim_to_tokens(recent_progress, PROMPT_CONTEXT_TOKEN_BUDGET)
     if streak >= 21:
         level = "Эксперт"
         motivation = "Вы выработали устойчивую привычку! Теперь фитнес - часть вашей жизни."
@@ -320,5 +559,7 @@ def generate_motivation(streak: int, goal: str, recent_progress: str = "") -> st
 Сгенерируйте короткое мотивационное сообщение (2-3 предложения) для поддержки пользователя.
 Сообщение должно быть энергичным, но без эмодзи и восклицаний."""
 
+    #Без персонального прогресса промпт зависит только от серии и цели — его можно кэшировать
     messages = [HumanMessage(content=prompt)]
-    return _invoke_llm(messages, use_system_prompt=True)
\ No newline at end of file
+    return await _invoke_llm(messages, use_system_prompt=True, cacheable=not recent_progress, name="generate_motivation",
+                             priority=Priority.MOTIVATION)
\ No newline at end of file
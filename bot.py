@@ -1,26 +1,91 @@
 import asyncio
+import html
+import logging
+import multiprocessing
+import signal
+import socket
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, BufferedInputFile
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from datetime import datetime, timedelta
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramAPIError
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from datetime import datetime
 from dotenv import load_dotenv
 import os
 
-from db import init_db, get_db
-from agents import generate_plan, chat_with_ai, generate_new_day_plan, analyze_progress, generate_motivation, \
-    generate_daily_workout
-from reports import validate_full_name, goal_map, level_map, make_excel, calculate_fitness_score
-from scheduler import scheduler, setup_user_reminders
+from db import init_db, create_pool, close_pool, acquire, fetch_progress_logs, fetch_workout_logs, \
+    acquire_leadership
+from agents import generate_plan, chat_with_ai, analyze_progress, generate_motivation, \
+    generate_daily_workout, summarize_progress, stream_daily_workout, stream_new_day_plan, regenerate_plan_section
+from reports import validate_full_name, goal_map, level_map, make_excel, score_from_stats, fetch_user_stats, \
+    record_weight, complete_workout, shutdown_report_executor, report_cache_key, get_cached_report, save_cached_report, REPORT_FILENAME
+from singleflight import single_flight
+from fsm_storage import create_storage, PostgresStorage
+from middlewares import InFlightMiddleware, UserMiddleware, RegistrationMiddleware
+from llm_scheduler import Priority, llm_scheduler
+from llm_metrics import llm_metrics
+import scheduler as reminders
+from chat_memory import load_conversation, remember_exchange, compact_conversation
+from user_cache import UserProfile, invalidate_user, start_invalidation_listener, stop_invalidation_listener
+from plans import insert_plan, save_plan, get_current_plan, get_current_workout_plan, get_plan_by_number, \
+    plan_history, prune_plans, replace_plan_if_current
+from plan_templates import template_plan
+from workout_plan import parse_plan, plan_profile, diff_plans
+from scheduler import scheduler, setup_user_reminders, start_reminder_dispatcher, stop_reminder_dispatcher, \
+    normalize_days
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+storage = create_storage()
+dp = Dispatcher(storage=storage)
+inflight_updates = InFlightMiddleware()
+dp.update.outer_middleware(inflight_updates)
+#Профиль загружается один раз на апдейт; обработчики с флагом registration_required
+#недоступны незарегистрированным
+dp.update.outer_middleware(UserMiddleware())
+dp.message.middleware(RegistrationMiddleware())
+dp.callback_query.middleware(RegistrationMiddleware())
+REGISTERED = {"registration_required": True}
+
+#polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+#Сколько секунд при остановке ждать завершения обрабатываемых апдейтов
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+#Метрики отдаются на отдельном внутреннем порту (0 — выключено), не на публичном порту webhook
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+#advisory-блокировка владельца планировщика
+SCHEDULER_LOCK_ID = 4715002
+
+#Минимальный интервал между редактированиями сообщения при потоковой выдаче (сек)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+#Заменять шаблонный план при регистрации версией от LLM (в фоне)
+PLAN_LLM_UPGRADE = os.getenv("PLAN_LLM_UPGRADE", "1") == "1"
+
+#Фоновые задачи, не привязанные к апдейту (отменяются при остановке)
+background_tasks = set()
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
 
 
@@ -67,16 +132,58 @@ def workout_keyboard():
     ])
 
 
+#Потоковая отправка плана
+async def answer_streaming(message: Message, header: str, chunks) -> str:
+    """
+    Отправляет заглушку и постепенно редактирует её по мере генерации текста.
+    Редактирования ограничены STREAM_EDIT_INTERVAL, чтобы не упираться в лимиты Telegram.
+    Возвращает полный сгенерированный текст, даже если Telegram отклонил редактирование, —
+    вызывающий код сохраняет его в БД.
+    """
+    sent = await message.answer(f"{header}\n\n⏳ Генерирую...")
+    loop = asyncio.get_running_loop()
+    text = ""
+    #Первое редактирование — сразу, как появится текст; интервал ограничивает только последующие
+    last_edit = float("-inf")
+
+    async for chunk in chunks:
+        text += chunk
+        now = loop.time()
+        if text.strip() and now - last_edit >= STREAM_EDIT_INTERVAL:
+            last_edit = now
+            try:
+                await sent.edit_text(f"{header}\n\n{text} ▌")
+            except TelegramRetryAfter as e:
+                #Flood-лимит: промежуточные правки откладываем, генерация продолжается
+                last_edit = now + e.retry_after
+            except TelegramAPIError:
+                #Промежуточный текст может быть неполным HTML — ждём следующую порцию
+                pass
+
+    try:
+        await sent.edit_text(f"{header}\n\n{text}")
+    except TelegramAPIError as e:
+        #Итоговый текст отправляем новым сообщением без разметки, чтобы он не потерялся
+        logger.warning("Не удалось отредактировать сообщение с планом: %s", e)
+        try:
+            await message.answer(text, parse_mode=None)
+        except TelegramAPIError as e:
+            logger.warning("Не удалось отправить план: %s", e)
+    return text
+
+
 # /start
 @dp.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, user: UserProfile | None):
     await state.clear()
 
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id=$1", message.from_user.id)
-    await conn.close()
-
     if user:
+        #Пользователь снова пишет боту — значит, разблокировал его
+        if user.is_active is False:
+            async with acquire() as conn:
+                await conn.execute("UPDATE users SET is_active=TRUE WHERE telegram_id=$1", message.from_user.id)
+            invalidate_user(message.from_user.id)
+
         await message.answer(
             f"Привет, {user['full_name']}!\n"
             "Вы уже зарегистрированы. Выберите действие:\n\n"
@@ -142,6 +249,7 @@ async def process_goal_cb(callback: CallbackQuery, state: FSMContext):
 
 
 @dp.callback_query(F.data.startswith("level_"))
+@single_flight("registration_plan")
 async def process_level_cb(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     level_key = callback.data.split("_")[1]
@@ -166,56 +274,57 @@ async def process_level_cb(callback: CallbackQuery, state: FSMContext):
         "coaching_mode": "level1"
     }
 
-    #Генерация плана (дневной тренировки)
-    plan = generate_daily_workout(user_data)
+    #Шаблонный план из каталога отправляется сразу, регистрация не ждёт LLM
+    workout_plan = template_plan(user_data, seed=callback.from_user.id)
+    plan = workout_plan.render()
+    await callback.message.answer(f"🎯 <b>Ваша первая тренировка:</b>\n\n{plan}")
 
     #Сохранение
-    conn = await get_db()
-    try:
-        await conn.execute("""
-            INSERT INTO users (telegram_id, username, full_name, height, weight, goal, fitness_score, 
-                              coaching_mode, current_plan, workout_streak, last_workout_date)
-            VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11)
-            ON CONFLICT (telegram_id) DO UPDATE SET 
-                full_name=$3, height=$4, weight=$5, goal=$6, current_plan=$9
-        """,
-                           callback.from_user.id, callback.from_user.username,
-                           user_data["full_name"], user_data["height"], user_data["weight"],
-                           user_data["goal"], user_data["fitness_score"], user_data["coaching_mode"],
-                           plan, 0, None
-                           )
-    except Exception as e:
-        #Если столбца нет, сохраняем без него
-        await conn.execute("""
-            INSERT INTO users (telegram_id, username, full_name, height, weight, goal, fitness_score, coaching_mode)
-            VALUES ($1,$2,$3,$4,$5,$6,$7,$8)
-            ON CONFLICT (telegram_id) DO UPDATE SET 
-                full_name=$3, height=$4, weight=$5, goal=$6
-        """,
-                           callback.from_user.id, callback.from_user.username,
-                           user_data["full_name"], user_data["height"], user_data["weight"],
-                           user_data["goal"], user_data["fitness_score"], user_data["coaching_mode"]
-                           )
-    await conn.close()
+    async with acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO users (telegram_id, username, full_name, height, weight, goal, fitness_score, 
+                                  coaching_mode, workout_streak, last_workout_date)
+                VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)
+                ON CONFLICT (telegram_id) DO UPDATE SET 
+                    full_name=$3, height=$4, weight=$5, goal=$6
+            """,
+                               callback.from_user.id, callback.from_user.username,
+                               user_data["full_name"], user_data["height"], user_data["weight"],
+                               user_data["goal"], user_data["fitness_score"], user_data["coaching_mode"],
+                               0, None
+                               )
+            plan_id = await insert_plan(conn, callback.from_user.id, plan, "template", workout_plan)
+    invalidate_user(callback.from_user.id)
 
-    await callback.message.answer(f"🎯 <b>Ваша первая тренировка:</b>\n\n{plan}")
     await callback.message.answer("🏋️ Используйте команду /workout для управления тренировками")
     await state.clear()
 
+    if PLAN_LLM_UPGRADE:
+        run_in_background(upgrade_template_plan(callback.message, callback.from_user.id, user_data, plan_id))
 
-# /update — обновление веса
-@dp.message(Command("update"))
-async def cmd_update(message: Message, state: FSMContext):
-    await state.clear()
-
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id=$1", message.from_user.id)
-    await conn.close()
 
-    if not user:
-        await message.answer("Сначала зарегистрируйтесь через /start")
+async def upgrade_template_plan(message: Message, user_id: int, user_data: dict, template_plan_id: int):
+    """
+    Заменяет шаблонный план персональным от LLM, если пользователь ещё не получил другой план.
+    """
+    try:
+        plan = await generate_daily_workout(user_data, priority=Priority.ONBOARDING)
+    except Exception as e:
+        logger.warning("Не удалось получить план от LLM для пользователя %s: %s", user_id, e)
         return
 
+    plan_id = await replace_plan_if_current(
+        user_id, template_plan_id, plan, "registration", parse_plan(plan, plan_profile(user_data))
+    )
+    if plan_id:
+        await message.answer(f"🎯 <b>Персональная версия вашей тренировки:</b>\n\n{plan}")
+
+
+# /update — обновление веса
+@dp.message(Command("update"), flags=REGISTERED)
+async def cmd_update(message: Message, state: FSMContext):
+    await state.clear()
     await message.answer("Введите новый вес (кг):")
     await state.set_state(Form.update_weight)
 
@@ -228,82 +337,77 @@ async def update_weight(message: Message, state: FSMContext):
         await message.answer("Введите число.")
         return
 
-    conn = await get_db()
-    #Сохраняем вес в users
-    await conn.execute("UPDATE users SET weight=$1 WHERE telegram_id=$2", weight, message.from_user.id)
-    #Также сохраняем в логи прогресса
-    await conn.execute("""
-        INSERT INTO progress_logs (telegram_id, weight) 
-        VALUES ($1, $2)
-    """, message.from_user.id, weight)
-    await conn.close()
+    #Сохраняем вес в users и логи прогресса, обновляем рейтинг
+    await record_weight(message.from_user.id, weight)
 
     await message.answer("✅ Вес обновлён.")
     await state.clear()
 
 #/newplan — новый план
-@dp.message(Command("newplan"))
-async def cmd_newplan(message: Message):
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id=$1", message.from_user.id)
-
-    if not user:
-        await conn.close()
-        await message.answer("Вы не зарегистрированы. Введите /start.")
-        return
-
-    user_dict = dict(user)
-    plan = generate_daily_workout(user_dict)
+@dp.message(Command("newplan"), flags=REGISTERED)
+@single_flight("newplan")
+async def cmd_newplan(message: Message, user: UserProfile):
+    user_dict = user.as_dict()
+    header = "🎯 <b>Ваш новый план:</b>"
+    profile = plan_profile(user_dict)
+
+    #Анкета не менялась — заново составляем только основную часть,
+    #разминка, заминка и питание остаются из текущего плана
+    current = await get_current_workout_plan(message.from_user.id)
+    if current and current.profile == profile:
+        sent = await message.answer(f"{header}\n\n⏳ Генерирую...")
+        workout_plan = await regenerate_plan_section(user_dict, current, "exercises")
+        if workout_plan:
+            text = workout_plan.render()
+            await sent.edit_text(f"{header}\n\n{text}")
+            await save_plan(message.from_user.id, text, "newplan", workout_plan)
+            return
+        await sent.delete()
 
-    #Сохраняем новый план в базу
-    try:
-        await conn.execute("UPDATE users SET current_plan=$1 WHERE telegram_id=$2", plan, message.from_user.id)
-    except Exception as e:
-        # Если столбца current_plan нет, создаем его
-        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS current_plan TEXT")
-        await conn.execute("UPDATE users SET current_plan=$1 WHERE telegram_id=$2", plan, message.from_user.id)
-    await conn.close()
+    plan = await answer_streaming(message, header, stream_daily_workout(user_dict))
 
-    await message.answer(f"🎯 <b>Ваш новый план:</b>\n\n{plan}")
+    #Сохраняем новый план в историю планов
+    await save_plan(message.from_user.id, plan, "newplan", parse_plan(plan, profile))
 
 
 #/plan — посмотреть текущий план
 
-@dp.message(Command("plan"))
-async def cmd_plan(message: Message):
-    conn = await get_db()
+#/plan history — список прошлых планов, /plan N — план с номером N из списка
+@dp.message(Command("plan"), flags=REGISTERED)
+async def cmd_plan(message: Message, command: CommandObject):
+    args = (command.args or "").strip()
 
-    #Проверяем существование столбца current_plan
-    try:
-        user = await conn.fetchrow("SELECT current_plan FROM users WHERE telegram_id=$1", message.from_user.id)
-    except Exception as e:
-        #Если столбца нет, создаем его
-        await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS current_plan TEXT")
-        user = await conn.fetchrow("SELECT current_plan FROM users WHERE telegram_id=$1", message.from_user.id)
-
-    await conn.close()
+    if args == "history":
+        history = await plan_history(message.from_user.id)
+        if not history:
+            await message.answer("У вас еще нет плана. Создайте его с помощью /newplan")
+            return
+        lines = [f"{number}. {created_at:%d.%m.%Y %H:%M}" for number, created_at, _ in history]
+        await message.answer(
+            "<b>История планов:</b>\n\n" + "\n".join(lines) +
+            "\n\nЧтобы открыть план, введите <code>/plan номер</code>"
+        )
+        return
 
-    if not user:
-        await message.answer("Вы не зарегистрированы. Введите /start.")
+    if args.isdigit() and int(args) > 0:
+        plan = await get_plan_by_number(message.from_user.id, int(args))
+        if not plan:
+            await message.answer("Плана с таким номером нет. Список: /plan history")
+            return
+        await message.answer(f"<b>План от {plan['created_at']:%d.%m.%Y}:</b>\n\n{plan['body']}")
         return
 
-    if not user['current_plan']:
+    current_plan = await get_current_plan(message.from_user.id)
+
+    if not current_plan:
         await message.answer("У вас еще нет плана. Создайте его с помощью /newplan")
         return
 
-    await message.answer(f"<b>Ваш текущий план:</b>\n\n{user['current_plan']}")
+    await message.answer(f"<b>Ваш текущий план:</b>\n\n{current_plan}")
 
 #/workout — управление тренировками
-@dp.message(Command("workout"))
-async def cmd_workout(message: Message):
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id=$1", message.from_user.id)
-    await conn.close()
-
-    if not user:
-        await message.answer("Сначала зарегистрируйтесь через /start")
-        return
-
+@dp.message(Command("workout"), flags=REGISTERED)
+async def cmd_workout(message: Message, user: UserProfile):
     #Получаем текущую статистику
     streak = user.get('workout_streak', 0) or 0
     last_workout = user.get('last_workout_date')
@@ -331,63 +435,28 @@ async def cmd_workout(message: Message):
 
 
 #Завершить тренировку
-@dp.callback_query(F.data == "finish_workout")
+@dp.callback_query(F.data == "finish_workout", flags=REGISTERED)
+@single_flight("finish_workout")
 async def finish_workout(callback: CallbackQuery):
     await callback.answer()
 
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id=$1", callback.from_user.id)
+    #Серия, рейтинг и журнал обновляются одним атомарным запросом
+    result = await complete_workout(callback.from_user.id)
 
-    if not user:
-        await conn.close()
+    if not result['registered']:
         await callback.message.answer("Сначала зарегистрируйтесь через /start")
         return
 
-    #Проверяем, не завершал ли уже тренировку сегодня
-    last_workout = user.get('last_workout_date')
-    today = datetime.now().date()
-
-    if last_workout:
-        last_workout_date = last_workout.date() if hasattr(last_workout, 'date') else last_workout
-        if last_workout_date == today:
-            await conn.close()
-            await callback.message.answer(
-                "✅ Вы уже завершили тренировку сегодня!\n"
-                "Можете начать новый день, чтобы получить новую тренировку."
-            )
-            return
-
-    #Обновляем статистику
-    streak = user.get('workout_streak', 0) or 0
-    yesterday = (datetime.now() - timedelta(days=1)).date()
-
-    if last_workout:
-        last_workout_date = last_workout.date() if hasattr(last_workout, 'date') else last_workout
-        if last_workout_date == yesterday:
-            streak += 1
-        elif last_workout_date < yesterday:
-            streak = 1
-        else:
-            streak = streak  #Если тренировка была сегодня или в будущем (не должно быть)
-    else:
-        streak = 1
-
-    #Увеличиваем fitness_score
-    new_score = (user.get('fitness_score', 0) or 0) + 10
-
-    await conn.execute("""
-        UPDATE users 
-        SET workout_streak=$1, last_workout_date=NOW(), fitness_score=$2
-        WHERE telegram_id=$3
-    """, streak, new_score, callback.from_user.id)
-
-    # Сохраняем запись о тренировке
-    await conn.execute("""
-        INSERT INTO workout_logs (telegram_id) 
-        VALUES ($1)
-    """, callback.from_user.id)
+    #Тренировка уже отмечена сегодня (в том числе повторным нажатием)
+    if result['streak'] is None:
+        await callback.message.answer(
+            "✅ Вы уже завершили тренировку сегодня!\n"
+            "Можете начать новый день, чтобы получить новую тренировку."
+        )
+        return
 
-    await conn.close()
+    streak = result['streak']
+    new_score = result['score']
 
     #Создаем прогресс-бар
     progress_bar = "🟩" * min(streak, 10) + "⬜" * (10 - min(streak, 10))
@@ -407,24 +476,21 @@ async def finish_workout(callback: CallbackQuery):
 
 
 # Начать новый день
-@dp.callback_query(F.data == "start_new_day")
-async def start_new_day(callback: CallbackQuery):
+@dp.callback_query(F.data == "start_new_day", flags=REGISTERED)
+@single_flight("start_new_day")
+async def start_new_day(callback: CallbackQuery, user: UserProfile):
     await callback.answer()
 
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id=$1", callback.from_user.id)
-
-    if not user:
-        await conn.close()
-        await callback.message.answer("Сначала зарегистрируйтесь через /start")
-        return
-
-    #Проверяем, завершена ли сегодняшняя тренировка
-    last_workout = user.get('last_workout_date')
+    #Проверяем, завершена ли сегодняшняя тренировка. Дату и серию читаем из БД, а не из кэша:
+    #тренировку могли только что завершить в другом процессе
+    async with acquire() as conn:
+        workout_state = await conn.fetchrow(
+            "SELECT last_workout_date, workout_streak FROM users WHERE telegram_id=$1", callback.from_user.id
+        )
+    last_workout = workout_state['last_workout_date']
     today = datetime.now().date()
 
     if not last_workout:
-        await conn.close()
         await callback.message.answer(
             "⚠️ Сначала завершите свою первую тренировку!\n"
             "Используйте кнопку 'Завершить тренировку'"
@@ -433,104 +499,109 @@ async def start_new_day(callback: CallbackQuery):
 
     last_workout_date = last_workout.date() if hasattr(last_workout, 'date') else last_workout
     if last_workout_date != today:
-        await conn.close()
         await callback.message.answer(
             "⚠️ Сначала завершите сегодняшнюю тренировку!\n"
             "Используйте кнопку 'Завершить тренировку'"
         )
         return
 
-    #Получаем историю веса для анализа прогресса
-    logs = await conn.fetch(
-        "SELECT weight, recorded_at FROM progress_logs WHERE telegram_id=$1 ORDER BY recorded_at",
-        callback.from_user.id
+    #Историю веса, логи тренировок и накопительные показатели читаем параллельно
+    log_list, workout_logs, stats, previous_plan = await asyncio.gather(
+        fetch_progress_logs(callback.from_user.id),
+        fetch_workout_logs(callback.from_user.id),
+        fetch_user_stats(callback.from_user.id),
+        get_current_workout_plan(callback.from_user.id),
     )
-    log_list = [(log['weight'], log['recorded_at']) for log in logs]
 
-    #Получаем логи тренировок
-    workout_logs_result = await conn.fetch(
-        "SELECT workout_date FROM workout_logs WHERE telegram_id=$1 ORDER BY workout_date",
-        callback.from_user.id
+    #Локальная сводка прогресса позволяет запустить анализ, план и мотивацию одновременно
+    user_dict = user.as_dict()
+    streak = workout_state['workout_streak'] or 0
+    progress_summary = summarize_progress(user_dict, log_list, workout_logs)
+
+    #План выдаётся потоком, пока параллельно готовятся анализ и мотивация
+    new_plan, progress_analysis, motivation = await asyncio.gather(
+        answer_streaming(
+            callback.message, "🎯 <b>Ваша новая тренировка на сегодня:</b>",
+            stream_new_day_plan(user_dict, streak, progress_summary)
+        ),
+        analyze_progress(user_dict, log_list, workout_logs),
+        generate_motivation(streak, user_dict.get('goal', 'не указана'), progress_summary),
     )
-    workout_logs = [(log['workout_date'],) for log in workout_logs_result]
-
-    #Анализируем прогресс
-    user_dict = dict(user)
-    progress_analysis = analyze_progress(user_dict, log_list, workout_logs)
-
-    #Генерируем новый план на день
-    streak = user.get('workout_streak', 0) or 0
-    new_plan = generate_new_day_plan(user_dict, streak, progress_analysis)
-
-    #Сохраняем новый план
-    await conn.execute("UPDATE users SET current_plan=$1 WHERE telegram_id=$2", new_plan, callback.from_user.id)
-
-    #Генерируем мотивационное сообщение
-    motivation = generate_motivation(streak, user_dict.get('goal', 'не указана'), progress_analysis)
 
     #Обновляем статистику (увеличиваем серию)
     streak += 1
-    fitness_score = calculate_fitness_score(user_dict, log_list)
+    fitness_score = score_from_stats(user_dict, stats)
+    workout_plan = parse_plan(new_plan, plan_profile(user_dict))
 
-    await conn.execute("""
-        UPDATE users SET workout_streak=$1, fitness_score=$2
-        WHERE telegram_id=$3
-    """, streak, fitness_score, callback.from_user.id)
+    async with acquire() as conn:
+        async with conn.transaction():
+            #Сохраняем новый план
+            await insert_plan(conn, callback.from_user.id, new_plan, "new_day", workout_plan)
 
-    await conn.close()
+            await conn.execute("""
+                UPDATE users SET workout_streak=$1, fitness_score=$2
+                WHERE telegram_id=$3
+            """, streak, fitness_score, callback.from_user.id)
+    invalidate_user(callback.from_user.id)
 
     #Создаем прогресс-бар
     progress_bar = "🟩" * min(streak, 10) + "⬜" * (10 - min(streak, 10))
 
-    #Отправляем два сообщения: статистику и новый план
+    #Что поменялось по сравнению со вчерашним планом
+    changes = diff_plans(previous_plan, workout_plan) if previous_plan and workout_plan else []
+    changes_text = (
+        "🔁 <b>Изменения к прошлому плану:</b>\n" + html.escape("\n".join(changes[:10])) + "\n\n"
+    ) if changes else ""
+
+    #Отправляем статистику (план уже отправлен потоком)
     await callback.message.answer(
         f"🔄 <b>Новый день начат!</b>\n\n"
         f"{motivation}\n\n"
         f"📊 <b>Анализ прогресса:</b>\n"
         f"{progress_analysis}\n\n"
+        f"{changes_text}"
         f"🔥 Серия тренировок: {streak} дней подряд\n"
         f"{progress_bar}\n\n"
         f"🏆 Общий рейтинг: {fitness_score} баллов\n\n"
         f"<i>Не забывайте обновлять вес с помощью /update</i>"
     )
 
-    #Отправляем новый план
-    await callback.message.answer(
-        f"🎯 <b>Ваша новая тренировка на сегодня:</b>\n\n"
-        f"{new_plan}"
-    )
-
 
 
 # /report — отчёт
-@dp.message(Command("report"))
-async def cmd_report(message: Message):
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id=$1", message.from_user.id)
-
-    if not user:
-        await conn.close()
-        await message.answer("Вы не зарегистрированы. Введите /start.")
-        return
-
-    #Получаем логи прогресса
-    logs = await conn.fetch(
-        "SELECT weight, recorded_at FROM progress_logs WHERE telegram_id=$1 ORDER BY recorded_at",
-        message.from_user.id
-    )
-    await conn.close()
-
-    #Преобразуем логи в нужный формат
-    log_list = [(log['weight'], log['recorded_at']) for log in logs]
+@dp.message(Command("report"), flags=REGISTERED)
+@single_flight("report")
+async def cmd_report(message: Message, user: UserProfile):
+    #Для ключа кэша достаточно времени последней записи и их количества
+    async with acquire() as conn:
+        stats = await conn.fetchrow(
+            "SELECT MAX(recorded_at) AS last_recorded_at, COUNT(*) AS log_count FROM progress_logs WHERE telegram_id=$1",
+            message.from_user.id
+        )
 
     #Получаем данные пользователя в виде словаря
-    user_dict = dict(user)
-
-    #Генерируем Excel файл
-    excel_file = await make_excel(user_dict, log_list)
+    user_dict = user.as_dict()
+    cache_key = report_cache_key(user_dict, stats['last_recorded_at'], stats['log_count'])
+
+    #Если данные не менялись, повторно отправляем уже загруженный в Telegram файл
+    cached = await get_cached_report(message.from_user.id, cache_key)
+    if cached:
+        file_id, data = cached
+        if file_id:
+            try:
+                await message.answer_document(file_id)
+                return
+            except TelegramBadRequest:
+                pass
+        excel_file = BufferedInputFile(data, REPORT_FILENAME)
+    else:
+        #Получаем логи прогресса и генерируем Excel файл
+        log_list = await fetch_progress_logs(message.from_user.id)
+        excel_file = await make_excel(user_dict, log_list)
 
-    #Отправляем файл
-    await message.answer_document(excel_file)
+    #Отправляем файл и запоминаем его file_id
+    sent = await message.answer_document(excel_file)
+    await save_cached_report(message.from_user.id, cache_key, sent.document.file_id, excel_file.data)
 
 
 
@@ -544,6 +615,7 @@ async def cmd_help(message: Message):
         "/report — получить отчет\n"
         "/newplan — сгенерировать новый план\n"
         "/plan — посмотреть текущий план\n"
+        "/plan history — история планов\n"
         "/workout — управление тренировками\n"
         "/setreminder — установить напоминания\n"
         "/help — справка\n\n"
@@ -557,16 +629,8 @@ async def cmd_help(message: Message):
 
 
 # Напоминания
-@dp.message(Command("setreminder"))
+@dp.message(Command("setreminder"), flags=REGISTERED)
 async def cmd_setreminder(message: Message, state: FSMContext):
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id=$1", message.from_user.id)
-    await conn.close()
-
-    if not user:
-        await message.answer("Сначала зарегистрируйтесь через /start")
-        return
-
     await message.answer(
         "Введите расписание напоминаний в формате:\n<code>mon,wed,fri 18:00</code>\n\n"
         "Примеры:\n"
@@ -583,6 +647,8 @@ async def process_reminder(message: Message, state: FSMContext):
         parts = message.text.split()
         days = parts[0]
         hour, minute = map(int, parts[1].split(":"))
+        if not normalize_days(days) or not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError(message.text)
     except:
         await message.answer("Неверный формат. Пример: <code>mon,wed,fri 18:00</code>")
         return
@@ -595,7 +661,7 @@ async def process_reminder(message: Message, state: FSMContext):
 
 # Общее общение с ИИ
 @dp.message()
-async def general_chat(message: Message, state: FSMContext):
+async def general_chat(message: Message, state: FSMContext, user: UserProfile | None):
     current_state = await state.get_state()
     if current_state:
         return
@@ -604,11 +670,7 @@ async def general_chat(message: Message, state: FSMContext):
         await message.answer("Неизвестная команда. Используйте /help для списка команд")
         return
 
-    # Получаем контекст пользователя для улучшенного ответа
-    conn = await get_db()
-    user = await conn.fetchrow("SELECT goal, workout_streak FROM users WHERE telegram_id=$1", message.from_user.id)
-    await conn.close()
-
+    # Контекст пользователя для улучшенного ответа
     context = {}
     if user:
         context = {
@@ -616,54 +678,149 @@ async def general_chat(message: Message, state: FSMContext):
             'streak': user.get('workout_streak', 0) or 0
         }
 
-    reply = chat_with_ai(message.text, context)
+    #Незарегистрированным память диалога не ведём (история привязана к users)
+    summary, history = await load_conversation(message.from_user.id) if user else ("", [])
+
+    reply = await chat_with_ai(message.text, context, history=history, summary=summary)
     await message.answer(reply)
 
+    if user:
+        await remember_exchange(message.from_user.id, message.text, reply)
+        run_in_background(compact_conversation(message.from_user.id))
 
 
-# Миграция базы данных при запуске
-async def migrate_db():
-    """Добавляем недостающие столбцы и таблицы если они не существуют"""
-    conn = await get_db()
-    try:
-        # Проверяем существование столбца current_plan
-        await conn.fetch("SELECT current_plan FROM users LIMIT 1")
-    except Exception as e:
-        if "столбец" in str(e).lower() and "не существует" in str(e).lower():
-            await conn.execute("ALTER TABLE users ADD COLUMN current_plan TEXT")
 
-    try:
-        await conn.fetch("SELECT workout_streak FROM users LIMIT 1")
-    except Exception as e:
-        if "столбец" in str(e).lower() and "не существует" in str(e).lower():
-            await conn.execute("ALTER TABLE users ADD COLUMN workout_streak INTEGER DEFAULT 0")
+# Запуск
+@dp.startup()
+async def on_startup(run_scheduler: bool | None = True):
+    await create_pool()
+    await init_db()  # Применяем миграции схемы
+    #Кэш профилей включается только вместе с подпиской на инвалидации других процессов
+    await start_invalidation_listener()
+    await start_metrics_server()
+    #Планировщик должен работать ровно в одном процессе;
+    #None — процессов несколько, владельца выбираем через advisory-блокировку
+    if run_scheduler is None:
+        run_scheduler = await acquire_leadership(SCHEDULER_LOCK_ID)
+    if run_scheduler:
+        start_reminder_dispatcher(bot)
+        if isinstance(storage, PostgresStorage):
+            scheduler.add_job(storage.purge_expired, "interval", minutes=10, id="fsm_purge", replace_existing=True)
+        scheduler.add_job(prune_plans, "cron", hour=4, id="plans_prune", replace_existing=True)
+        scheduler.start()
+
+
+@dp.shutdown()
+async def on_shutdown():
+    #Даём обработчикам, которые уже начали работу, завершиться
+    await inflight_updates.wait_idle(SHUTDOWN_DRAIN_TIMEOUT)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await stop_reminder_dispatcher(SHUTDOWN_DRAIN_TIMEOUT)
+    shutdown_report_executor()
+    await stop_invalidation_listener()
+    await stop_metrics_server()
+    await close_pool()
 
-    try:
-        await conn.fetch("SELECT last_workout_date FROM users LIMIT 1")
-    except Exception as e:
-        if "столбец" in str(e).lower() and "не существует" in str(e).lower():
-            await conn.execute("ALTER TABLE users ADD COLUMN last_workout_date TIMESTAMP")
-
-    # Создаем таблицу для логов тренировок
-    await conn.execute("""
-        CREATE TABLE IF NOT EXISTS workout_logs (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT REFERENCES users(telegram_id) ON DELETE CASCADE,
-            workout_date TIMESTAMP DEFAULT NOW()
-        )
-    """)
 
-    await conn.close()
+async def main():
+    #Polling и webhook взаимоисключающие — снимаем webhook, если он был установлен
+    await bot.delete_webhook()
+    await dp.start_polling(bot)
 
 
+#Режим webhook
+async def set_webhook():
+    await bot.set_webhook(
+        f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    await bot.session.close()
+
+
+#Метрики процесса: очередь LLM, токены и задержки, рассылка напоминаний
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.json_response({
+        "pid": os.getpid(),
+        "llm_scheduler": llm_scheduler.metrics(),
+        "llm": llm_metrics.snapshot(),
+        "broadcast": reminders.broadcaster.metrics() if reminders.broadcaster else None,
+    })
 
-# Запуск
-async def main():
-    await init_db()
-    await migrate_db()  # Выполняем миграцию
-    scheduler.start()
-    await dp.start_polling(bot)
+
+_metrics_runner: web.AppRunner | None = None
+
+
+async def start_metrics_server():
+    """
+    Внутренний HTTP-сервер метрик, работает во всех режимах запуска.
+    Процессов может быть несколько — порт общий (SO_REUSEPORT), каждый отвечает своими метриками.
+    """
+    global _metrics_runner
+    if not METRICS_PORT or _metrics_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT, reuse_port=hasattr(socket, "SO_REUSEPORT")).start()
+    _metrics_runner = runner
+
+
+async def stop_metrics_server():
+    global _metrics_runner
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+
+
+def run_webhook_worker(run_scheduler: bool | None):
+    """
+    Один процесс aiohttp-сервера. При нескольких воркерах порт общий (SO_REUSEPORT).
+    """
+    dp["run_scheduler"] = run_scheduler
+    app = web.Application()
+    #Запросы без верного X-Telegram-Bot-Api-Secret-Token отклоняются
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=WEBHOOK_WORKERS > 1)
+
+
+def run_webhook():
+    #Без секрета SimpleRequestHandler принимает любой POST — такой режим не запускаем
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise SystemExit("BOT_MODE=webhook требует WEBHOOK_URL и WEBHOOK_SECRET")
+    asyncio.run(set_webhook())
+    if WEBHOOK_WORKERS <= 1:
+        run_webhook_worker(run_scheduler=True)
+        return
+
+    workers = [
+        multiprocessing.Process(target=run_webhook_worker, args=(None,), name=f"webhook-{index}")
+        for index in range(WEBHOOK_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+
+    #SIGTERM передаём воркерам — каждый корректно завершает свои обработчики
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    #Ctrl+C и так получает вся группа процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for worker in workers:
+        worker.join()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,157 @@
+# broadcast.py
+import asyncio
+import logging
+import os
+import time
+
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest,
+    TelegramNetworkError, TelegramServerError
+)
+
+from db import acquire
+from user_cache import invalidate_user
+
+logger = logging.getLogger(__name__)
+
+#Ниже глобального лимита Telegram (~30 сообщений в секунду)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_QUEUE_SIZE = int(os.getenv("BROADCAST_QUEUE_SIZE", "100000"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+
+class TokenBucket:
+    """
+    Ограничитель скорости: не больше rate отправок в секунду, всплеск до capacity.
+    pause() останавливает выдачу токенов (например, после RetryAfter от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class Broadcaster:
+    """
+    Очередь массовой рассылки: ограниченное число воркеров, общий TokenBucket,
+    повтор после RetryAfter и сетевых ошибок, пометка заблокировавших бота пользователей.
+    """
+
+    def __init__(self, bot, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY,
+                 queue_size: int = BROADCAST_QUEUE_SIZE, max_retries: int = BROADCAST_MAX_RETRIES):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.stats = {"sent": 0, "retried": 0, "blocked": 0, "failed": 0, "dropped": 0}
+        self._workers = []
+        self._started_at = None
+
+    def start(self):
+        if self._workers:
+            return
+        self._started_at = time.monotonic()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, drain: bool = True, timeout: float | None = None):
+        """
+        Останавливает воркеров. drain — сначала дослать очередь, но не дольше timeout секунд;
+        недосланные сообщения считаются отброшенными.
+        """
+        if drain:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("broadcast: очередь не дослана за %s с, осталось %s", timeout, self.queue.qsize())
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.stats["dropped"] += 1
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def enqueue(self, chat_id: int, text: str) -> bool:
+        """
+        Ставит сообщение в очередь. При переполнении сообщение отбрасывается.
+        """
+        try:
+            self.queue.put_nowait((chat_id, text))
+            return True
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            return False
+
+    def metrics(self) -> dict:
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0
+        return {
+            **self.stats,
+            "queue_depth": self.queue.qsize(),
+            "throughput": self.stats["sent"] / elapsed if elapsed else 0.0,
+        }
+
+    async def _worker(self):
+        while True:
+            chat_id, text = await self.queue.get()
+            try:
+                await self._deliver(chat_id, text)
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.exception("broadcast: ошибка отправки пользователю %s: %s", chat_id, e)
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, chat_id: int, text: str):
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                self.stats["sent"] += 1
+                return
+            except TelegramRetryAfter as e:
+                #Flood-лимит общий для бота — притормаживаем всех воркеров
+                self.stats["retried"] += 1
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                self.stats["blocked"] += 1
+                await mark_user_inactive(chat_id)
+                return
+            except TelegramBadRequest as e:
+                self.stats["failed"] += 1
+                logger.warning("broadcast: сообщение пользователю %s отклонено: %s", chat_id, e)
+                return
+            except (TelegramNetworkError, TelegramServerError):
+                self.stats["retried"] += 1
+                await asyncio.sleep(2 ** attempt)
+        self.stats["dropped"] += 1
+
+
+#Пользователь заблокировал бота — больше не рассылаем ему напоминания
+async def mark_user_inactive(user_id: int):
+    async with acquire() as conn:
+        await conn.execute("UPDATE users SET is_active=FALSE WHERE telegram_id=$1", user_id)
+    invalidate_user(user_id)
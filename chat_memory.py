@@ -0,0 +1,97 @@
+# chat_memory.py
+import logging
+import os
+
+from db import acquire
+from agents import summarize_conversation
+from llm_metrics import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+#Сколько последних реплик хранится дословно (кольцевой буфер)
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "20"))
+#Бюджет токенов на дословную историю; сверх него старые реплики сворачиваются в резюме
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1500"))
+
+#Пользователи, чья история сейчас сжимается
+_compacting = set()
+
+
+async def load_conversation(user_id: int) -> tuple[str, list]:
+    """
+    Возвращает (резюме, [(role, content), ...]) в хронологическом порядке.
+    """
+    async with acquire() as conn:
+        summary = await conn.fetchval("SELECT summary FROM chat_summaries WHERE telegram_id=$1", user_id)
+        rows = await conn.fetch("""
+            SELECT role, content FROM chat_messages
+            WHERE telegram_id=$1 ORDER BY id DESC LIMIT $2
+        """, user_id, CHAT_HISTORY_MAX_MESSAGES)
+    return summary or "", [(row['role'], row['content']) for row in reversed(rows)]
+
+
+async def remember_exchange(user_id: int, user_message: str, reply: str):
+    """
+    Сохраняет реплику пользователя и ответ. Сжатие истории — compact_conversation.
+    """
+    async with acquire() as conn:
+        await conn.executemany(
+            "INSERT INTO chat_messages (telegram_id, role, content) VALUES ($1, $2, $3)",
+            [(user_id, "user", user_message), (user_id, "assistant", reply)]
+        )
+
+
+async def compact_conversation(user_id: int):
+    """
+    При превышении лимитов сворачивает старую часть истории в резюме.
+    Запускается в фоне; одновременно для пользователя идёт не больше одного сжатия.
+    """
+    if user_id in _compacting:
+        return
+    _compacting.add(user_id)
+    try:
+        await _compact(user_id)
+    except Exception as e:
+        logger.warning("chat_memory: сжатие истории пользователя %s прервано: %s", user_id, e)
+    finally:
+        _compacting.discard(user_id)
+
+
+async def _compact(user_id: int):
+    async with acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT id, role, content FROM chat_messages WHERE telegram_id=$1 ORDER BY id", user_id
+        )
+        summary = await conn.fetchval("SELECT summary FROM chat_summaries WHERE telegram_id=$1", user_id)
+
+    tokens = sum(estimate_tokens(row['content']) for row in rows)
+    if len(rows) <= CHAT_HISTORY_MAX_MESSAGES and tokens <= CHAT_HISTORY_TOKEN_BUDGET:
+        return
+
+    #Сворачиваем самые старые реплики, пока остаток не уложится в половину бюджета
+    keep = list(rows)
+    old = []
+    while keep and (len(keep) > CHAT_HISTORY_MAX_MESSAGES // 2 or tokens > CHAT_HISTORY_TOKEN_BUDGET // 2):
+        row = keep.pop(0)
+        old.append(row)
+        tokens -= estimate_tokens(row['content'])
+    if not old:
+        return
+
+    try:
+        summary = await summarize_conversation(summary or "", [(row['role'], row['content']) for row in old])
+    except Exception as e:
+        #Без резюме старые реплики всё равно вытесняются, как в кольцевом буфере
+        logger.warning("chat_memory: не удалось сжать историю пользователя %s: %s", user_id, e)
+        summary = None
+
+    async with acquire() as conn:
+        async with conn.transaction():
+            if summary:
+                await conn.execute("""
+                    INSERT INTO chat_summaries (telegram_id, summary) VALUES ($1, $2)
+                    ON CONFLICT (telegram_id) DO UPDATE SET summary=$2, updated_at=NOW()
+                """, user_id, summary)
+            await conn.execute(
+                "DELETE FROM chat_messages WHERE telegram_id=$1 AND id <= $2", user_id, old[-1]['id']
+            )
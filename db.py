@@ -1,36 +1,150 @@
 # db.py
 import asyncpg
 import os
+from contextlib import asynccontextmanager
+from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
 
-async def get_db():
-    return await asyncpg.connect(os.getenv("DATABASE_URL"))
-
-async def init_db():
-    conn = await get_db()
-    await conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_id BIGINT PRIMARY KEY,
-            username TEXT,
-            full_name TEXT NOT NULL,
-            height INT NOT NULL,
-            weight REAL NOT NULL,
-            goal TEXT NOT NULL,
-            fitness_score INT DEFAULT 0,
-            coaching_mode TEXT DEFAULT 'level1',
-            registered_at TIMESTAMP DEFAULT NOW(),
-            level_entered_at TIMESTAMP DEFAULT NOW(),
-            last_export TIMESTAMP,
-            next_reminder_days TEXT DEFAULT 'mon,wed,fri',
-            current_plan TEXT  -- ДОБАВЛЕНО
-        );
-        CREATE TABLE IF NOT EXISTS progress_logs (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT REFERENCES users(telegram_id) ON DELETE CASCADE,
-            weight REAL NOT NULL,
-            recorded_at TIMESTAMP DEFAULT NOW()
-        );
-    """)
-    await conn.close()
\ No newline at end of file
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+MIGRATIONS_LOCK_ID = 4715001
+
+#Общий пул соединений процесса, создаётся в обработчике on_startup диспетчера
+pool: asyncpg.Pool | None = None
+
+
+async def create_pool() -> asyncpg.Pool:
+    global pool
+    if pool is None:
+        pool = await asyncpg.create_pool(
+            os.getenv("DATABASE_URL"),
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        )
+    return pool
+
+
+async def close_pool():
+    global pool
+    await release_leadership()
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+#Выбор единственного процесса-лидера (например, владельца планировщика)
+_leader_conn: asyncpg.Connection | None = None
+
+
+async def acquire_leadership(lock_id: int) -> bool:
+    """
+    Пытается взять сессионную advisory-блокировку на отдельном соединении.
+    Блокировка держится, пока процесс жив, и освобождается при его остановке.
+    """
+    global _leader_conn
+    if _leader_conn is not None:
+        return True
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    if await conn.fetchval("SELECT pg_try_advisory_lock($1)", lock_id):
+        _leader_conn = conn
+        return True
+    await conn.close()
+    return False
+
+
+async def release_leadership():
+    global _leader_conn
+    if _leader_conn is not None:
+        await _leader_conn.close()
+        _leader_conn = None
+
+
+@asynccontextmanager
+async def acquire():
+    """
+    Берёт соединение из общего пула и возвращает его обратно после использования.
+    """
+    if pool is None:
+        raise RuntimeError("Пул соединений не создан: вызовите create_pool() при запуске")
+    async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+        yield conn
+
+
+async def fetch_progress_logs(user_id: int) -> list:
+    """
+    История веса пользователя: [(weight, recorded_at), ...] по возрастанию даты.
+    """
+    async with acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT weight, recorded_at FROM progress_logs WHERE telegram_id=$1 ORDER BY recorded_at",
+            user_id
+        )
+    return [(row['weight'], row['recorded_at']) for row in rows]
+
+
+async def fetch_workout_logs(user_id: int) -> list:
+    """
+    Даты тренировок пользователя: [(workout_date,), ...] по возрастанию.
+    """
+    async with acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT workout_date FROM workout_logs WHERE telegram_id=$1 ORDER BY workout_date",
+            user_id
+        )
+    return [(row['workout_date'],) for row in rows]
+
+
+#Версионированные миграции схемы
+def migration_files() -> list:
+    """
+    Файлы migrations/NNNN_*.sql, отсортированные по номеру версии.
+    """
+    files = []
+    for path in MIGRATIONS_DIR.glob("*.sql"):
+        version = int(path.name.split("_", 1)[0])
+        files.append((version, path))
+    return sorted(files)
+
+
+async def schema_version(conn) -> int:
+    try:
+        return await conn.fetchval("SELECT MAX(version) FROM schema_version") or 0
+    except asyncpg.UndefinedTableError:
+        return 0
+
+
+async def init_db() -> int:
+    """
+    Применяет недостающие миграции. Если схема актуальна, выполняется один запрос.
+    Возвращает текущую версию схемы.
+    """
+    migrations = migration_files()
+    latest = migrations[-1][0]
+
+    async with acquire() as conn:
+        if await schema_version(conn) >= latest:
+            return latest
+
+        #Несколько процессов могут стартовать одновременно — миграции выполняет один
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATIONS_LOCK_ID)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    applied_at TIMESTAMP DEFAULT NOW()
+                )
+            """)
+            current = await schema_version(conn)
+            for version, path in migrations:
+                if version <= current:
+                    continue
+                await conn.execute(path.read_text(encoding="utf-8"))
+                await conn.execute("INSERT INTO schema_version (version) VALUES ($1)", version)
+    return latest
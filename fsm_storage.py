@@ -0,0 +1,98 @@
+# fsm_storage.py
+import json
+import os
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from db import acquire
+
+#memory | postgres | redis
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+#Незавершённые сценарии (например, брошенная регистрация) старше этого срока забываются
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states: общее для всех воркеров бота.
+    Пустые записи удаляются сразу, устаревшие — игнорируются и чистятся purge_expired().
+    """
+
+    def __init__(self, ttl: int = FSM_STATE_TTL):
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = [key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                 getattr(key, "business_connection_id", None), key.destiny]
+        return ":".join("" if part is None else str(part) for part in parts)
+
+    async def _fetch(self, key: StorageKey):
+        async with acquire() as conn:
+            return await conn.fetchrow("""
+                SELECT state, data FROM fsm_states
+                WHERE key=$1 AND updated_at > NOW() - make_interval(secs => $2)
+            """, self._key(key), self.ttl)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        async with acquire() as conn:
+            await conn.execute("""
+                INSERT INTO fsm_states (key, state) VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE SET state=$2, updated_at=NOW()
+            """, self._key(key), value)
+            if value is None:
+                await conn.execute(
+                    "DELETE FROM fsm_states WHERE key=$1 AND state IS NULL AND data='{}'::jsonb",
+                    self._key(key)
+                )
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._fetch(key)
+        return row['state'] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        async with acquire() as conn:
+            await conn.execute("""
+                INSERT INTO fsm_states (key, data) VALUES ($1, $2::jsonb)
+                ON CONFLICT (key) DO UPDATE SET data=$2::jsonb, updated_at=NOW()
+            """, self._key(key), json.dumps(data, ensure_ascii=False))
+            if not data:
+                await conn.execute(
+                    "DELETE FROM fsm_states WHERE key=$1 AND state IS NULL AND data='{}'::jsonb",
+                    self._key(key)
+                )
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._fetch(key)
+        return json.loads(row['data']) if row else {}
+
+    async def purge_expired(self) -> None:
+        async with acquire() as conn:
+            await conn.execute(
+                "DELETE FROM fsm_states WHERE updated_at <= NOW() - make_interval(secs => $1)",
+                self.ttl
+            )
+
+    async def close(self) -> None:
+        pass
+
+
+def create_storage() -> BaseStorage:
+    """
+    Хранилище FSM по переменной FSM_STORAGE.
+    """
+    if FSM_STORAGE == "postgres":
+        return PostgresStorage()
+    if FSM_STORAGE == "redis":
+        #redis — необязательная зависимость, нужна только для этого режима
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(
+            os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+            state_ttl=FSM_STATE_TTL,
+            data_ttl=FSM_STATE_TTL,
+        )
+    return MemoryStorage()
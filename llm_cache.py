@@ -0,0 +1,136 @@
+# llm_cache.py
+import hashlib
+import logging
+import os
+import random
+import re
+import time
+from collections import OrderedDict
+
+from db import acquire
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "86400"))
+#Сколько разных вариантов ответа копится на один промпт перед повторным использованием
+LLM_CACHE_VARIETY = int(os.getenv("LLM_CACHE_VARIETY", "3"))
+LLM_CACHE_POSTGRES = os.getenv("LLM_CACHE_POSTGRES", "0") == "1"
+
+
+def prompt_key(*parts: str) -> str:
+    """
+    Хэш нормализованного промпта: регистр и пробелы не влияют на ключ.
+    """
+    normalized = "\x1f".join(re.sub(r"\s+", " ", part).strip().lower() for part in parts)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    """
+    LRU-кэш в памяти процесса: ключ -> список вариантов ответа с общим сроком жизни.
+    """
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> list:
+        entry = self._entries.get(key)
+        if entry is None:
+            return []
+        expires_at, variants = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return []
+        self._entries.move_to_end(key)
+        return variants
+
+    def set(self, key: str, variants: list):
+        self._entries[key] = (time.monotonic() + self.ttl, list(variants))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def add(self, key: str, response: str):
+        variants = self.get(key)
+        if variants:
+            variants.append(response)
+        else:
+            self.set(key, [response])
+
+
+class PostgresCache:
+    """
+    Общий для всех процессов уровень кэша в таблице llm_cache.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    async def get(self, key: str) -> list:
+        async with acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT response FROM llm_cache
+                WHERE key=$1 AND created_at > NOW() - make_interval(secs => $2)
+                ORDER BY created_at
+            """, key, self.ttl)
+        return [row['response'] for row in rows]
+
+    async def add(self, key: str, response: str):
+        #Заодно удаляем устаревшие варианты этого ключа
+        async with acquire() as conn:
+            await conn.execute("""
+                WITH expired AS (
+                    DELETE FROM llm_cache
+                    WHERE key=$1 AND created_at <= NOW() - make_interval(secs => $3)
+                )
+                INSERT INTO llm_cache (key, response) VALUES ($1, $2)
+            """, key, response, self.ttl)
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов LLM (память + необязательно Postgres).
+    Пока для ключа накоплено меньше variety вариантов, get() возвращает None,
+    чтобы был сгенерирован новый вариант; затем отдаётся случайный из накопленных.
+    """
+
+    def __init__(self, max_entries: int, ttl: int, variety: int = 1, use_postgres: bool = False):
+        self.variety = max(1, variety)
+        self.memory = MemoryCache(max_entries, ttl)
+        self.postgres = PostgresCache(ttl) if use_postgres else None
+
+    async def get(self, key: str) -> str | None:
+        variants = self.memory.get(key)
+        if not variants and self.postgres is not None:
+            try:
+                variants = await self.postgres.get(key)
+            except Exception as e:
+                logger.warning("llm_cache: чтение из Postgres не удалось: %s", e)
+                variants = []
+            if variants:
+                self.memory.set(key, variants[-self.variety:])
+        if len(variants) < self.variety:
+            return None
+        return random.choice(variants)
+
+    async def add(self, key: str, response: str):
+        if len(self.memory.get(key)) >= self.variety:
+            return
+        self.memory.add(key, response)
+        if self.postgres is not None:
+            try:
+                await self.postgres.add(key, response)
+            except Exception as e:
+                logger.warning("llm_cache: запись в Postgres не удалась: %s", e)
+
+
+response_cache = ResponseCache(
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_TTL,
+    variety=LLM_CACHE_VARIETY,
+    use_postgres=LLM_CACHE_POSTGRES,
+) if LLM_CACHE_ENABLED else None
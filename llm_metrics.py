@@ -0,0 +1,103 @@
+# llm_metrics.py
+import math
+import os
+import re
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+
+#Пользователь, для которого выполняется текущий апдейт (выставляет middleware)
+current_user: ContextVar[int | None] = ContextVar("current_user", default=None)
+
+#Сколько пользователей держать в метриках (самые давние вытесняются)
+LLM_METRICS_MAX_USERS = int(os.getenv("LLM_METRICS_MAX_USERS", "10000"))
+#Сколько последних замеров задержки хранить на функцию для перцентилей
+LLM_METRICS_LATENCY_WINDOW = int(os.getenv("LLM_METRICS_LATENCY_WINDOW", "500"))
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_RE = re.compile(r"(?<=[.!?\n])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Локальная оценка числа токенов без токенизатора модели:
+    знак препинания — токен, слово — ~4 латинских или ~3 кириллических символа на токен.
+    """
+    tokens = 0
+    for piece in _TOKEN_RE.findall(text):
+        if piece.isascii():
+            tokens += max(1, math.ceil(len(piece) / 4))
+        else:
+            tokens += max(1, math.ceil(len(piece) / 3))
+    return tokens
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Обрезает текст по границам предложений, чтобы он уложился в max_tokens.
+    """
+    if not text or estimate_tokens(text) <= max_tokens:
+        return text
+    kept, used = [], 0
+    for sentence in _SENTENCE_RE.split(text):
+        cost = estimate_tokens(sentence)
+        if used + cost > max_tokens:
+            break
+        kept.append(sentence)
+        used += cost
+    return " ".join(kept) + " …" if kept else ""
+
+
+def _new_stats() -> dict:
+    return {"calls": 0, "cache_hits": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_total": 0.0}
+
+
+class LLMMetrics:
+    """
+    Счётчики токенов и задержек LLM в разрезе функций агента и пользователей.
+    """
+
+    def __init__(self, max_users: int, latency_window: int):
+        self.max_users = max_users
+        self.latency_window = latency_window
+        self.by_function = {}
+        self.by_user = OrderedDict()
+        self._latencies = {}
+
+    def _user_stats(self, user_id: int) -> dict:
+        stats = self.by_user.get(user_id)
+        if stats is None:
+            stats = self.by_user[user_id] = _new_stats()
+            while len(self.by_user) > self.max_users:
+                self.by_user.popitem(last=False)
+        else:
+            self.by_user.move_to_end(user_id)
+        return stats
+
+    def record(self, name: str, prompt_tokens: int, completion_tokens: int, latency: float, cached: bool = False):
+        user_id = current_user.get()
+        targets = [self.by_function.setdefault(name, _new_stats())]
+        if user_id is not None:
+            targets.append(self._user_stats(user_id))
+        for stats in targets:
+            stats["calls"] += 1
+            stats["cache_hits"] += int(cached)
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["latency_total"] += latency
+        if not cached:
+            self._latencies.setdefault(name, deque(maxlen=self.latency_window)).append(latency)
+
+    def snapshot(self) -> dict:
+        functions = {}
+        for name, stats in self.by_function.items():
+            latencies = sorted(self._latencies.get(name, ()))
+            functions[name] = {
+                **stats,
+                "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+                "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            }
+        #Разбивка по пользователям (их telegram_id) наружу не отдаётся — только их число
+        return {"functions": functions, "users_tracked": len(self.by_user)}
+
+
+llm_metrics = LLMMetrics(LLM_METRICS_MAX_USERS, LLM_METRICS_LATENCY_WINDOW)
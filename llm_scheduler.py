@@ -0,0 +1,169 @@
+# llm_scheduler.py
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+#Лимиты Groq на запросы и токены в минуту
+LLM_RPM = int(os.getenv("LLM_RPM", "30"))
+LLM_TPM = int(os.getenv("LLM_TPM", "6000"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+
+
+class Priority(IntEnum):
+    """
+    Классы приоритета: меньшее значение обслуживается раньше.
+    """
+    ONBOARDING = 0
+    PLAN = 1
+    CHAT = 2
+    MOTIVATION = 3
+    BACKGROUND = 4
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def retry_after(error: Exception) -> float | None:
+    """
+    Значение заголовка Retry-After из ответа провайдера, если он есть.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMScheduler:
+    """
+    Очередь запросов к LLM с приоритетами: выдаёт слот, только если свободна
+    одна из max_concurrency позиций и запрос укладывается в лимиты RPM/TPM
+    за скользящую минуту. После 429 выдача слотов приостанавливается для всех.
+    """
+
+    def __init__(self, max_concurrency: int, rpm: int, tpm: int):
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.tpm = tpm
+        self.active = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._window = deque()
+        self._paused_until = 0.0
+        self._wake_handle = None
+        self.stats = {"granted": 0, "rate_limited": 0, "retries": 0}
+
+    def _prune(self, now: float):
+        while self._window and self._window[0][0] <= now - 60:
+            self._window.popleft()
+
+    #Через сколько секунд запрос на tokens токенов уложится в лимиты (0 — сейчас)
+    def _delay(self, tokens: int, now: float) -> float:
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._prune(now)
+        if not self._window:
+            return 0.0
+        used = sum(entry[1] for entry in self._window)
+        if len(self._window) < self.rpm and used + tokens <= self.tpm:
+            return 0.0
+        return self._window[0][0] + 60 - now
+
+    def _wake(self):
+        self._wake_handle = None
+        now = time.monotonic()
+        while self._queue and self.active < self.max_concurrency:
+            _, _, tokens, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+            delay = self._delay(tokens, now)
+            if delay > 0:
+                self._wake_handle = asyncio.get_running_loop().call_later(delay, self._wake)
+                return
+            heapq.heappop(self._queue)
+            entry = [now, tokens]
+            self._window.append(entry)
+            self.active += 1
+            self.stats["granted"] += 1
+            future.set_result(entry)
+
+    def _schedule_wake(self):
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, priority: int, tokens: int):
+        """
+        Ждёт своей очереди по приоритету и лимитам. Возвращает запись окна,
+        в которой можно уточнить фактическое число токенов (entry[1]).
+        """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (int(priority), next(self._seq), tokens, future))
+        self._schedule_wake()
+        try:
+            entry = await future
+        except asyncio.CancelledError:
+            #Слот мог быть выдан одновременно с отменой — возвращаем его
+            if future.done() and not future.cancelled():
+                self.active -= 1
+                self._schedule_wake()
+            raise
+        try:
+            yield entry
+        finally:
+            self.active -= 1
+            self._schedule_wake()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def backoff(self, error: Exception, attempt: int) -> bool:
+        """
+        Обработка 429: приостанавливает выдачу слотов и ждёт с экспоненциальной задержкой и джиттером.
+        Возвращает False, если повторять не нужно.
+        """
+        if not is_rate_limit_error(error) or attempt >= LLM_MAX_RETRIES:
+            return False
+        self.stats["rate_limited"] += 1
+        self.stats["retries"] += 1
+        delay = retry_after(error) or LLM_BACKOFF_BASE * 2 ** attempt
+        delay += random.uniform(0, delay / 2)
+        logger.warning("LLM: лимит провайдера (429), повтор через %.1f с", delay)
+        self.pause(delay)
+        await asyncio.sleep(delay)
+        return True
+
+    def metrics(self) -> dict:
+        now = time.monotonic()
+        self._prune(now)
+        depth = {}
+        for priority, _, _, future in self._queue:
+            if not future.done():
+                name = Priority(priority).name.lower()
+                depth[name] = depth.get(name, 0) + 1
+        return {
+            **self.stats,
+            "active": self.active,
+            "queue_depth": depth,
+            "requests_last_minute": len(self._window),
+            "tokens_last_minute": sum(entry[1] for entry in self._window),
+            "paused_for": max(0.0, self._paused_until - now),
+        }
+
+
+llm_scheduler = LLMScheduler(LLM_MAX_CONCURRENCY, LLM_RPM, LLM_TPM)
@@ -0,0 +1,90 @@
+# middlewares.py
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import TelegramObject, CallbackQuery
+
+from llm_metrics import current_user
+from user_cache import get_user
+
+NOT_REGISTERED_TEXT = "Сначала зарегистрируйтесь через /start"
+
+
+class InFlightMiddleware(BaseMiddleware):
+    """
+    Считает обрабатываемые апдейты, чтобы при остановке дождаться их завершения.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        self.count += 1
+        self._idle.clear()
+        #Запоминаем пользователя для метрик LLM в разрезе пользователей
+        user = data.get("event_from_user")
+        current_user.set(user.id if user else None)
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if not self.count:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """
+        Ждёт завершения всех обработчиков не дольше timeout секунд.
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class UserMiddleware(BaseMiddleware):
+    """
+    Один раз на апдейт загружает профиль отправителя (через кэш профилей)
+    и передаёт его обработчикам как data["user"]; None — не зарегистрирован.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        from_user = data.get("event_from_user")
+        data["user"] = await get_user(from_user.id) if from_user else None
+        return await handler(event, data)
+
+
+class RegistrationMiddleware(BaseMiddleware):
+    """
+    Не пускает незарегистрированных к обработчикам с флагом registration_required.
+    Работает как inner-middleware: флаги известны только после выбора обработчика.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if data.get("user") is not None or not get_flag(data, "registration_required"):
+            return await handler(event, data)
+
+        if isinstance(event, CallbackQuery):
+            await event.answer()
+            await event.message.answer(NOT_REGISTERED_TEXT)
+        else:
+            await event.answer(NOT_REGISTERED_TEXT)
@@ -0,0 +1,11 @@
+-- Серии тренировок и журнал тренировок (раньше добавлялись в bot.migrate_db)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS current_plan TEXT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS workout_streak INTEGER DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_workout_date TIMESTAMP;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE;
+
+CREATE TABLE IF NOT EXISTS workout_logs (
+    id SERIAL PRIMARY KEY,
+    telegram_id BIGINT REFERENCES users(telegram_id) ON DELETE CASCADE,
+    workout_date TIMESTAMP DEFAULT NOW()
+);
@@ -0,0 +1,8 @@
+-- Общий уровень кэша ответов LLM (llm_cache.PostgresCache)
+CREATE TABLE IF NOT EXISTS llm_cache (
+    id SERIAL PRIMARY KEY,
+    key TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS llm_cache_key_idx ON llm_cache (key, created_at);
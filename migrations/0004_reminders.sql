@@ -0,0 +1,19 @@
+-- Расписания напоминаний и слоты для ежеминутного диспетчера
+CREATE TABLE IF NOT EXISTS reminders (
+    telegram_id BIGINT PRIMARY KEY REFERENCES users(telegram_id) ON DELETE CASCADE,
+    days TEXT NOT NULL,
+    hour INT NOT NULL,
+    minute INT NOT NULL,
+    timezone TEXT,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS reminder_slots (
+    telegram_id BIGINT REFERENCES users(telegram_id) ON DELETE CASCADE,
+    weekday SMALLINT NOT NULL,
+    hour SMALLINT NOT NULL,
+    minute SMALLINT NOT NULL,
+    kind TEXT NOT NULL,
+    PRIMARY KEY (weekday, hour, minute, kind, telegram_id)
+);
+CREATE INDEX IF NOT EXISTS reminder_slots_user_idx ON reminder_slots (telegram_id);
@@ -0,0 +1,3 @@
+-- Индексы под выборки истории пользователя (отчёт, новый день)
+CREATE INDEX IF NOT EXISTS progress_logs_user_recorded_idx ON progress_logs (telegram_id, recorded_at);
+CREATE INDEX IF NOT EXISTS workout_logs_user_date_idx ON workout_logs (telegram_id, workout_date);
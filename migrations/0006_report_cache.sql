@@ -0,0 +1,8 @@
+-- Готовые xlsx-отчёты и file_id, полученный от Telegram при первой отправке
+CREATE TABLE IF NOT EXISTS report_cache (
+    telegram_id BIGINT PRIMARY KEY REFERENCES users(telegram_id) ON DELETE CASCADE,
+    cache_key TEXT NOT NULL,
+    file_id TEXT,
+    data BYTEA,
+    created_at TIMESTAMP DEFAULT NOW()
+);
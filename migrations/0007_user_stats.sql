@@ -0,0 +1,29 @@
+-- Накопительные показатели пользователя для расчёта рейтинга за O(1)
+CREATE TABLE IF NOT EXISTS user_stats (
+    telegram_id BIGINT PRIMARY KEY REFERENCES users(telegram_id) ON DELETE CASCADE,
+    log_count INT NOT NULL DEFAULT 0,
+    active_days INT NOT NULL DEFAULT 0,
+    first_log_at TIMESTAMP,
+    last_log_date DATE,
+    first_weight REAL,
+    latest_weight REAL,
+    workout_count INT NOT NULL DEFAULT 0
+);
+
+-- Заполняем по уже накопленной истории
+INSERT INTO user_stats (telegram_id, log_count, active_days, first_log_at, last_log_date, first_weight, latest_weight)
+SELECT
+    telegram_id,
+    COUNT(*),
+    COUNT(DISTINCT recorded_at::date),
+    MIN(recorded_at),
+    MAX(recorded_at)::date,
+    (ARRAY_AGG(weight ORDER BY recorded_at))[1],
+    (ARRAY_AGG(weight ORDER BY recorded_at DESC))[1]
+FROM progress_logs
+GROUP BY telegram_id
+ON CONFLICT (telegram_id) DO NOTHING;
+
+INSERT INTO user_stats (telegram_id, workout_count)
+SELECT telegram_id, COUNT(*) FROM workout_logs GROUP BY telegram_id
+ON CONFLICT (telegram_id) DO UPDATE SET workout_count = EXCLUDED.workout_count;
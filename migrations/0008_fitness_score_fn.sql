@@ -0,0 +1,26 @@
+-- Формула рейтинга на стороне БД (повторяет reports.score_from_stats),
+-- чтобы завершение тренировки выполнялось одним атомарным запросом
+CREATE OR REPLACE FUNCTION fitness_score(
+    goal TEXT,
+    base_weight REAL,
+    log_count INT,
+    active_days INT,
+    first_log_at TIMESTAMP,
+    first_weight REAL,
+    latest_weight REAL,
+    workout_count INT
+) RETURNS INT LANGUAGE SQL STABLE AS $$
+    SELECT LEAST(300, GREATEST(0,
+        COALESCE(log_count, 0) * 3
+        + CASE WHEN COALESCE(log_count, 0) > 0 THEN
+            LEAST(100, FLOOR(8 * CASE goal
+                WHEN 'похудение' THEN GREATEST(0, COALESCE(first_weight, base_weight) - latest_weight)
+                WHEN 'набор мышечной массы' THEN GREATEST(0, latest_weight - COALESCE(first_weight, base_weight))
+                ELSE LEAST(12, log_count)
+            END))::int
+            + LEAST(50, COALESCE(active_days, 0) / 3)
+            + LEAST(40, (FLOOR(EXTRACT(EPOCH FROM (NOW() AT TIME ZONE 'UTC' - first_log_at)) / 86400)::int / 30) * 5)
+          ELSE 0 END
+        + COALESCE(workout_count, 0) * 10
+    ))
+$$;
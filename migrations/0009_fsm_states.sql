@@ -0,0 +1,8 @@
+-- Состояния FSM aiogram (fsm_storage.PostgresStorage)
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data JSONB NOT NULL DEFAULT '{}'::jsonb,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS fsm_states_updated_idx ON fsm_states (updated_at);
@@ -0,0 +1,15 @@
+-- Память диалога с ИИ: последние реплики и сжатое резюме более старых
+CREATE TABLE IF NOT EXISTS chat_messages (
+    id BIGSERIAL PRIMARY KEY,
+    telegram_id BIGINT REFERENCES users(telegram_id) ON DELETE CASCADE,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS chat_messages_user_idx ON chat_messages (telegram_id, id);
+
+CREATE TABLE IF NOT EXISTS chat_summaries (
+    telegram_id BIGINT PRIMARY KEY REFERENCES users(telegram_id) ON DELETE CASCADE,
+    summary TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
@@ -0,0 +1,32 @@
+-- Планы — отдельная таблица только на добавление; в users остаётся ссылка на текущий
+CREATE TABLE IF NOT EXISTS plans (
+    id BIGSERIAL PRIMARY KEY,
+    telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+    source TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plans_user_idx ON plans (telegram_id, id DESC);
+
+-- Тексты планов уходят в TOAST; lz4 (PostgreSQL 14+) сжимает быстрее pglz,
+-- на старых версиях или без lz4 остаётся сжатие по умолчанию.
+-- EXECUTE: до PostgreSQL 14 синтаксис SET COMPRESSION неизвестен, и статический запрос
+-- упал бы ещё при компиляции блока, мимо обработчика исключений
+DO $$
+BEGIN
+    EXECUTE 'ALTER TABLE plans ALTER COLUMN body SET COMPRESSION lz4';
+EXCEPTION WHEN feature_not_supported OR syntax_error THEN
+    NULL;
+END $$;
+
+-- Без индекса по current_plan_id смена плана остаётся HOT-обновлением строки users
+ALTER TABLE users ADD COLUMN IF NOT EXISTS current_plan_id BIGINT REFERENCES plans(id) ON DELETE SET NULL;
+
+INSERT INTO plans (telegram_id, source, body)
+SELECT telegram_id, 'migrated', current_plan FROM users WHERE current_plan IS NOT NULL;
+
+UPDATE users SET current_plan_id = plans.id
+FROM plans
+WHERE plans.telegram_id = users.telegram_id AND plans.source = 'migrated';
+
+ALTER TABLE users DROP COLUMN IF EXISTS current_plan;
@@ -0,0 +1,2 @@
+-- Структурированный план (workout_plan.WorkoutPlan) рядом с текстом; NULL — ответ не удалось разобрать
+ALTER TABLE plans ADD COLUMN IF NOT EXISTS data JSONB;
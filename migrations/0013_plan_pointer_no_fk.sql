@@ -0,0 +1,4 @@
+-- Внешний ключ users.current_plan_id -> plans заставлял при каждом удалении плана
+-- сканировать users целиком (индекса по указателю нет, чтобы смена плана оставалась
+-- HOT-обновлением). Текущий план защищает от удаления проверка в plans.prune_plans.
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_current_plan_id_fkey;
@@ -0,0 +1,158 @@
+# plan_templates.py
+import random
+from collections import defaultdict
+from datetime import date
+
+from workout_plan import WorkoutPlan, Exercise, Nutrition, plan_profile
+
+GOALS = ("похудение", "набор мышечной массы", "поддержание формы")
+LEVELS = {"новичок": 1, "средний": 2, "продвинутый": 3}
+
+#Каталог упражнений: (название, группа мышц, минимальный уровень, цели; пусто — для всех целей)
+CATALOGUE = (
+    ("Отжимания от колен", "грудь", 1, ()),
+    ("Отжимания от пола", "грудь", 2, ()),
+    ("Жим гантелей лёжа", "грудь", 2, ("набор мышечной массы", "поддержание формы")),
+    ("Отжимания с узкой постановкой рук", "грудь", 3, ()),
+    ("Тяга гантели в наклоне", "спина", 1, ()),
+    ("Супермен", "спина", 1, ()),
+    ("Тяга резинки к поясу", "спина", 1, ("похудение", "поддержание формы")),
+    ("Подтягивания", "спина", 3, ("набор мышечной массы", "поддержание формы")),
+    ("Приседания", "ноги", 1, ()),
+    ("Выпады", "ноги", 1, ()),
+    ("Ягодичный мост", "ноги", 1, ()),
+    ("Приседания с гантелями", "ноги", 2, ("набор мышечной массы", "поддержание формы")),
+    ("Болгарские сплит-приседания", "ноги", 3, ()),
+    ("Жим гантелей стоя", "плечи", 2, ("набор мышечной массы", "поддержание формы")),
+    ("Разведения гантелей в стороны", "плечи", 1, ()),
+    ("Сгибания рук с гантелями", "бицепс", 1, ("набор мышечной массы",)),
+    ("Обратные отжимания от скамьи", "трицепс", 2, ()),
+    ("Планка", "пресс", 1, ()),
+    ("Скручивания", "пресс", 1, ()),
+    ("Подъёмы ног лёжа", "пресс", 2, ()),
+    ("Велосипед", "пресс", 2, ()),
+    ("Джампинг джек", "кардио", 1, ("похудение", "поддержание формы")),
+    ("Бег на месте с высоким подниманием колен", "кардио", 1, ("похудение",)),
+    ("Скалолаз", "кардио", 2, ("похудение", "поддержание формы")),
+    ("Бёрпи", "кардио", 3, ("похудение",)),
+)
+
+#Группы мышц, обязательные в каждой тренировке (как в промпте generate_daily_workout)
+REQUIRED_GROUPS = ("грудь", "спина", "ноги", "пресс")
+EXTRA_GROUPS = {
+    "похудение": ("кардио", "кардио", "ноги"),
+    "набор мышечной массы": ("плечи", "бицепс", "трицепс", "ноги"),
+    "поддержание формы": ("плечи", "кардио", "трицепс"),
+}
+#Объём подхода по цели: (подходы, повторы для силовых, время для статики и кардио)
+VOLUME = {
+    "похудение": (3, "15", "45 секунд"),
+    "набор мышечной массы": (4, "8-12", "40 секунд"),
+    "поддержание формы": (3, "10-15", "30-60 секунд"),
+}
+TIMED = {"Планка", "Супермен"}
+
+WARMUPS = (
+    "Ходьба на месте - 2 минуты",
+    "Вращения в плечевых суставах - 30 секунд",
+    "Наклоны корпуса в стороны - 10 раз",
+    "Махи ногами вперёд-назад - по 10 раз",
+    "Лёгкие приседания без веса - 15 раз",
+    "Вращения тазом - 30 секунд",
+)
+COOLDOWNS = (
+    "Растяжка задней поверхности бедра - 30 секунд на ногу",
+    "Растяжка квадрицепса стоя - 30 секунд на ногу",
+    "Растяжка грудных мышц у стены - 30 секунд",
+    "Поза ребёнка - 1 минута",
+    "Растяжка трицепса над головой - 30 секунд на руку",
+    "Спокойное дыхание лёжа - 1 минута",
+)
+#Калорийность на кг веса и белок/жиры в граммах на кг веса
+NUTRITION = {
+    "похудение": (26, 1.8, 0.8),
+    "набор мышечной массы": (35, 2.0, 1.0),
+    "поддержание формы": (30, 1.6, 0.9),
+}
+MEALS = {
+    "похудение": (
+        "Завтрак: омлет из 2 яиц с овощами",
+        "Обед: куриная грудка, гречка, салат",
+        "Ужин: запечённая рыба с овощами",
+        "Перекус: творог или греческий йогурт",
+    ),
+    "набор мышечной массы": (
+        "Завтрак: овсянка на молоке с бананом и орехами",
+        "Обед: говядина, рис, овощи",
+        "Ужин: курица с макаронами из твёрдых сортов",
+        "Перекусы: творог, орехи, банан",
+    ),
+    "поддержание формы": (
+        "Завтрак: овсянка с ягодами и яйцо",
+        "Обед: индейка, булгур, салат",
+        "Ужин: рыба с овощами",
+        "Перекус: фрукты или йогурт",
+    ),
+}
+DISCLAIMER = "Перед началом программы проконсультируйтесь с врачом, если есть хронические заболевания."
+
+
+def _build_index() -> dict:
+    index = defaultdict(list)
+    for name, group, min_level, goals in CATALOGUE:
+        for goal in goals or GOALS:
+            index[(goal, group)].append((min_level, name))
+    return index
+
+
+#(цель, группа мышц) -> [(минимальный уровень, название), ...]
+CATALOGUE_INDEX = _build_index()
+
+
+def _exercise(name: str, group: str, goal: str) -> Exercise:
+    sets, reps, seconds = VOLUME[goal]
+    timed = group == "кардио" or name in TIMED
+    return Exercise(name=name, muscle_group=group, sets=sets, reps=seconds if timed else reps)
+
+
+def _nutrition(goal: str, weight: float) -> Nutrition:
+    kcal_per_kg, protein_per_kg, fat_per_kg = NUTRITION[goal]
+    calories = round(weight * kcal_per_kg / 50) * 50
+    protein = round(weight * protein_per_kg)
+    fat = round(weight * fat_per_kg)
+    carbs = max(0, round((calories - protein * 4 - fat * 9) / 4))
+    return Nutrition(
+        protein=f"{protein} г", carbs=f"{carbs} г", fat=f"{fat} г", calories=f"{calories} ккал",
+        meals=list(MEALS[goal]),
+    )
+
+
+def template_plan(user_data: dict, seed=None) -> WorkoutPlan:
+    """
+    Часовая тренировка из каталога упражнений по цели и уровню, без обращения к LLM.
+    Структура та же, что в промпте generate_daily_workout. seed задаёт вариант (по умолчанию — дата).
+    """
+    goal = user_data["goal"] if user_data["goal"] in GOALS else "поддержание формы"
+    level = LEVELS.get(user_data.get("level"), 1)
+    rng = random.Random(f"{seed if seed is not None else date.today()}|{goal}|{level}")
+
+    exercises, used = [], set()
+    for group in REQUIRED_GROUPS + EXTRA_GROUPS[goal]:
+        available = [(min_level, name) for min_level, name in CATALOGUE_INDEX[(goal, group)]
+                     if min_level <= level and name not in used]
+        #Предпочитаем упражнения своего уровня, более простые — если других нет
+        options = [name for min_level, name in available if min_level >= level - 1] or [name for _, name in available]
+        if options:
+            name = rng.choice(options)
+            used.add(name)
+            exercises.append(_exercise(name, group, goal))
+
+    return WorkoutPlan(
+        title=f"Тренировка на день: {goal}",
+        warmup=rng.sample(WARMUPS, 4),
+        exercises=exercises,
+        cooldown=rng.sample(COOLDOWNS, 3),
+        nutrition=_nutrition(goal, user_data["weight"]),
+        notes=[DISCLAIMER],
+        profile=plan_profile(user_data),
+    )
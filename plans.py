@@ -0,0 +1,116 @@
+# plans.py
+import os
+
+from db import acquire
+from workout_plan import WorkoutPlan
+
+#Сколько последних планов хранить на пользователя (текущий не удаляется никогда)
+PLAN_HISTORY_KEEP = int(os.getenv("PLAN_HISTORY_KEEP", "30"))
+#Сколько строк удалять за один запрос при очистке
+PLAN_PRUNE_BATCH = int(os.getenv("PLAN_PRUNE_BATCH", "5000"))
+
+
+async def insert_plan(conn, user_id: int, body: str, source: str, plan: WorkoutPlan | None = None) -> int:
+    """
+    Добавляет план и делает его текущим. Вызывается внутри транзакции conn.
+    source: template | registration | newplan | new_day; plan — разобранная структура, если есть.
+    """
+    plan_id = await conn.fetchval(
+        "INSERT INTO plans (telegram_id, source, body, data) VALUES ($1, $2, $3, $4::jsonb) RETURNING id",
+        user_id, source, body, plan.to_json() if plan else None
+    )
+    await conn.execute("UPDATE users SET current_plan_id=$1 WHERE telegram_id=$2", plan_id, user_id)
+    return plan_id
+
+
+async def save_plan(user_id: int, body: str, source: str, plan: WorkoutPlan | None = None) -> int:
+    async with acquire() as conn:
+        async with conn.transaction():
+            return await insert_plan(conn, user_id, body, source, plan)
+
+
+async def replace_plan_if_current(user_id: int, expected_plan_id: int, body: str, source: str,
+                                  plan: WorkoutPlan | None = None) -> int | None:
+    """
+    Добавляет план, только если текущим всё ещё остаётся expected_plan_id
+    (пользователь за это время не получил другой план). None — план не заменён.
+    """
+    async with acquire() as conn:
+        async with conn.transaction():
+            current = await conn.fetchval(
+                "SELECT current_plan_id FROM users WHERE telegram_id=$1 FOR UPDATE", user_id
+            )
+            if current != expected_plan_id:
+                return None
+            return await insert_plan(conn, user_id, body, source, plan)
+
+
+async def get_current_plan(user_id: int) -> str | None:
+    async with acquire() as conn:
+        return await conn.fetchval("""
+            SELECT plans.body FROM users
+            JOIN plans ON plans.id = users.current_plan_id
+            WHERE users.telegram_id=$1
+        """, user_id)
+
+
+async def get_current_workout_plan(user_id: int) -> WorkoutPlan | None:
+    """
+    Структура текущего плана; None — плана нет или он сохранён только текстом.
+    """
+    async with acquire() as conn:
+        data = await conn.fetchval("""
+            SELECT plans.data FROM users
+            JOIN plans ON plans.id = users.current_plan_id
+            WHERE users.telegram_id=$1
+        """, user_id)
+    return WorkoutPlan.from_json(data) if data else None
+
+
+async def get_plan_by_number(user_id: int, number: int):
+    """
+    План по номеру в истории: 1 — самый свежий. Возвращает запись (body, created_at) или None.
+    """
+    async with acquire() as conn:
+        return await conn.fetchrow("""
+            SELECT body, created_at FROM plans
+            WHERE telegram_id=$1 ORDER BY id DESC OFFSET $2 LIMIT 1
+        """, user_id, number - 1)
+
+
+async def plan_history(user_id: int, limit: int = 10) -> list:
+    """
+    Последние планы без текста: [(номер, created_at, source), ...], самый свежий первым.
+    """
+    async with acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT created_at, source FROM plans
+            WHERE telegram_id=$1 ORDER BY id DESC LIMIT $2
+        """, user_id, limit)
+    return [(number, row['created_at'], row['source']) for number, row in enumerate(rows, start=1)]
+
+
+async def prune_plans(keep: int = PLAN_HISTORY_KEEP) -> int:
+    """
+    Удаляет планы старше последних keep у каждого пользователя, пачками по PLAN_PRUNE_BATCH.
+    Возвращает число удалённых строк.
+    """
+    #Внешнего ключа на plans у users нет: текущий план защищает только проверка NOT EXISTS
+    deleted = 0
+    while True:
+        async with acquire() as conn:
+            result = await conn.execute("""
+                DELETE FROM plans WHERE id IN (
+                    SELECT ranked.id FROM (
+                        SELECT id, row_number() OVER (PARTITION BY telegram_id ORDER BY id DESC) AS position
+                        FROM plans
+                    ) AS ranked
+                    WHERE ranked.position > $1
+                      AND NOT EXISTS (SELECT 1 FROM users WHERE users.current_plan_id = ranked.id)
+                    LIMIT $2
+                )
+            """, keep, PLAN_PRUNE_BATCH)
+        count = int(result.split()[-1])
+        deleted += count
+        if count < PLAN_PRUNE_BATCH:
+            return deleted
@@ -1,9 +1,15 @@
 # reports.py
+import asyncio
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from openpyxl import Workbook
 from io import BytesIO
 from aiogram.types import BufferedInputFile
-from datetime import datetime, timedelta
-from db import get_db
+from datetime import datetime
+from db import acquire
+from user_cache import invalidate_user
 import re
 
 
@@ -32,32 +38,154 @@ def validate_full_name(text: str) -> bool:
     return True
 
 
-def calculate_fitness_score(user_data: dict, logs: list) -> int:
+#Очки за одну завершённую тренировку
+WORKOUT_POINTS = 10
+
+
+def score_from_stats(user_data: dict, stats: dict) -> int:
+    """
+    Рейтинг по накопительным показателям из user_stats — без обхода истории.
+    Та же формула есть в SQL-функции fitness_score (migrations/0008) — менять вместе.
+    """
     score = 0
-    score += len(logs) * 3
-    if logs:
-        init = user_data["weight"]
-        curr = logs[-1][0]
+    log_count = stats.get("log_count") or 0
+    score += log_count * 3
+    if log_count:
+        init = stats.get("first_weight") or user_data["weight"]
+        curr = stats["latest_weight"]
         goal = user_data["goal"]
         if goal == "похудение":
             kg = max(0, init - curr)
         elif goal == "набор мышечной массы":
             kg = max(0, curr - init)
         else:
-            kg = min(12, len(logs))
+            kg = min(12, log_count)
         score += int(min(100, kg * 8))
-        active_days = len({log[1].date() for log in logs})
-        score += min(50, active_days // 3)
-        first = min(log[1] for log in logs)
-        months = (datetime.utcnow() - first).days // 30
+        score += min(50, (stats.get("active_days") or 0) // 3)
+        months = (datetime.utcnow() - stats["first_log_at"]).days // 30
         score += min(40, months * 5)
+    score += (stats.get("workout_count") or 0) * WORKOUT_POINTS
     return min(300, max(0, score))
 
 
+def calculate_fitness_score(user_data: dict, logs: list, workout_count: int = 0) -> int:
+    """
+    Рейтинг по полной истории веса; считает те же показатели, что хранятся в user_stats.
+    """
+    stats = {"workout_count": workout_count}
+    if logs:
+        stats.update(
+            log_count=len(logs),
+            active_days=len({log[1].date() for log in logs}),
+            first_log_at=min(log[1] for log in logs),
+            first_weight=user_data["weight"],
+            latest_weight=logs[-1][0],
+        )
+    return score_from_stats(user_data, stats)
+
+
+async def fetch_user_stats(user_id: int) -> dict:
+    async with acquire() as conn:
+        row = await conn.fetchrow("SELECT * FROM user_stats WHERE telegram_id=$1", user_id)
+    return dict(row) if row else {}
+
+
+async def record_weight(user_id: int, weight: float) -> int:
+    """
+    Сохраняет новый вес, инкрементально обновляет user_stats и рейтинг.
+    Возвращает новый рейтинг.
+    """
+    async with acquire() as conn:
+        async with conn.transaction():
+            user_data = await conn.fetchrow(
+                "SELECT goal, weight FROM users WHERE telegram_id=$1 FOR UPDATE", user_id
+            )
+            #Первый вес берём из анкеты до её обновления
+            stats = await conn.fetchrow("""
+                INSERT INTO user_stats (telegram_id, log_count, active_days, first_log_at,
+                                        last_log_date, first_weight, latest_weight)
+                VALUES ($1, 1, 1, NOW(), CURRENT_DATE, $3, $2)
+                ON CONFLICT (telegram_id) DO UPDATE SET
+                    log_count = user_stats.log_count + 1,
+                    active_days = user_stats.active_days
+                        + (user_stats.last_log_date IS DISTINCT FROM CURRENT_DATE)::int,
+                    first_log_at = COALESCE(user_stats.first_log_at, NOW()),
+                    last_log_date = CURRENT_DATE,
+                    first_weight = COALESCE(user_stats.first_weight, $3),
+                    latest_weight = $2
+                RETURNING *
+            """, user_id, weight, user_data["weight"])
+            score = score_from_stats(dict(user_data), dict(stats))
+
+            await conn.execute(
+                "UPDATE users SET weight=$1, fitness_score=$2 WHERE telegram_id=$3", weight, score, user_id
+            )
+            await conn.execute(
+                "INSERT INTO progress_logs (telegram_id, weight) VALUES ($1, $2)", user_id, weight
+            )
+    invalidate_user(user_id)
+    return score
+
+
+#Завершение тренировки одним запросом: серия, журнал, user_stats и рейтинг.
+#Повторное нажатие в тот же день (в том числе одновременное) ничего не меняет:
+#второй запрос ждёт блокировку строки и после неё уже не проходит условие по дате.
+COMPLETE_WORKOUT_SQL = """
+    WITH u AS (
+        SELECT telegram_id, goal, weight, workout_streak, last_workout_date
+        FROM users
+        WHERE telegram_id = $1
+          AND (last_workout_date IS NULL OR last_workout_date::date < CURRENT_DATE)
+        FOR UPDATE
+    ),
+    s AS (
+        INSERT INTO user_stats (telegram_id, workout_count)
+        SELECT telegram_id, 1 FROM u
+        ON CONFLICT (telegram_id) DO UPDATE SET workout_count = user_stats.workout_count + 1
+        RETURNING *
+    ),
+    upd AS (
+        UPDATE users SET
+            workout_streak = CASE
+                WHEN u.last_workout_date::date = CURRENT_DATE - 1 THEN COALESCE(u.workout_streak, 0) + 1
+                ELSE 1
+            END,
+            last_workout_date = NOW(),
+            fitness_score = fitness_score(
+                u.goal, u.weight, s.log_count, s.active_days, s.first_log_at,
+                s.first_weight, s.latest_weight, s.workout_count
+            )
+        FROM u JOIN s ON s.telegram_id = u.telegram_id
+        WHERE users.telegram_id = u.telegram_id
+        RETURNING users.workout_streak, users.fitness_score
+    ),
+    log AS (
+        INSERT INTO workout_logs (telegram_id) SELECT telegram_id FROM u
+    )
+    SELECT
+        EXISTS (SELECT 1 FROM users WHERE telegram_id = $1) AS registered,
+        upd.workout_streak AS streak,
+        upd.fitness_score AS score
+    FROM (SELECT 1) AS one
+    LEFT JOIN upd ON TRUE
+"""
+
+
+async def complete_workout(user_id: int):
+    """
+    Атомарно отмечает тренировку за сегодня.
+    Возвращает запись (registered, streak, score); streak = None, если тренировка уже отмечена.
+    """
+    async with acquire() as conn:
+        result = await conn.fetchrow(COMPLETE_WORKOUT_SQL, user_id)
+    if result['streak'] is not None:
+        invalidate_user(user_id)
+    return result
+
+
 async def can_export(user_id: int) -> tuple[bool, int]:
-    conn = await get_db()
-    row = await conn.fetchrow("SELECT last_export FROM users WHERE telegram_id = $1", user_id)
-    await conn.close()
+    async with acquire() as conn:
+        row = await conn.fetchrow("SELECT last_export FROM users WHERE telegram_id = $1", user_id)
     if not row or not row['last_export']:
         return True, 0
     days = (datetime.utcnow() - row['last_export']).days
@@ -65,9 +193,9 @@ async def can_export(user_id: int) -> tuple[bool, int]:
 
 
 async def update_export_time(user_id: int):
-    conn = await get_db()
-    await conn.execute("UPDATE users SET last_export = NOW() WHERE telegram_id = $1", user_id)
-    await conn.close()
+    async with acquire() as conn:
+        await conn.execute("UPDATE users SET last_export = NOW() WHERE telegram_id = $1", user_id)
+    invalidate_user(user_id)
 
 
 def get_level_info(score: int):
@@ -79,10 +207,30 @@ def get_level_info(score: int):
         return "Продвинутый", "level3", "mon,tue,wed,thu,fri,sat"
 
 
-async def make_excel(user_data: dict, logs: list) -> BufferedInputFile:
-    wb = Workbook()
-    ws1 = wb.active
-    ws1.title = "Прогресс"
+#Построение отчёта выполняется в отдельном процессе, чтобы не блокировать бота
+REPORT_MAX_CONCURRENCY = int(os.getenv("REPORT_MAX_CONCURRENCY", "2"))
+REPORT_FILENAME = "fitmind_report.xlsx"
+_report_executor = None
+_report_semaphore = asyncio.Semaphore(REPORT_MAX_CONCURRENCY)
+
+
+def _get_report_executor() -> ProcessPoolExecutor:
+    global _report_executor
+    if _report_executor is None:
+        #fork из процесса с работающим циклом событий и потоками рискует унаследовать
+        #захваченные блокировки — дочерние процессы создаёт отдельный forkserver
+        _report_executor = ProcessPoolExecutor(
+            max_workers=REPORT_MAX_CONCURRENCY, mp_context=multiprocessing.get_context("forkserver")
+        )
+    return _report_executor
+
+
+def build_excel(user_data: dict, logs: list) -> bytes:
+    """
+    Собирает xlsx в режиме write-only: строки пишутся потоком, без хранения всех ячеек.
+    """
+    wb = Workbook(write_only=True)
+    ws1 = wb.create_sheet("Прогресс")
     ws1.append(["Дата", "Вес (кг)"])
     for w, dt in logs:
         ws1.append([dt.strftime("%Y-%m-%d"), w])
@@ -100,5 +248,53 @@ async def make_excel(user_data: dict, logs: list) -> BufferedInputFile:
 
     buf = BytesIO()
     wb.save(buf)
-    buf.seek(0)
-    return BufferedInputFile(buf.read(), "fitmind_report.xlsx")
\ No newline at end of file
+    #getvalue() отдаёт содержимое без seek() + read()
+    return buf.getvalue()
+
+
+async def make_excel(user_data: dict, logs: list) -> BufferedInputFile:
+    async with _report_semaphore:
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(_get_report_executor(), build_excel, dict(user_data), logs)
+    return BufferedInputFile(data, REPORT_FILENAME)
+
+
+def shutdown_report_executor():
+    global _report_executor
+    if _report_executor is not None:
+        _report_executor.shutdown(wait=False, cancel_futures=True)
+        _report_executor = None
+
+
+#Ключ кэша отчёта: меняется при новой записи веса или изменении анкеты
+def report_cache_key(user_data: dict, last_recorded_at, log_count: int) -> str:
+    profile = (
+        user_data["full_name"], user_data["height"], user_data["weight"],
+        user_data["goal"], user_data.get("fitness_score", 0),
+    )
+    raw = f"{profile}|{last_recorded_at}|{log_count}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def get_cached_report(user_id: int, cache_key: str):
+    """
+    Возвращает (file_id, data) сохранённого отчёта, если ключ совпадает, иначе None.
+    """
+    async with acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT file_id, data FROM report_cache WHERE telegram_id=$1 AND cache_key=$2",
+            user_id, cache_key
+        )
+    if not row:
+        return None
+    return row['file_id'], row['data']
+
+
+async def save_cached_report(user_id: int, cache_key: str, file_id: str | None, data: bytes):
+    async with acquire() as conn:
+        await conn.execute("""
+            INSERT INTO report_cache (telegram_id, cache_key, file_id, data)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (telegram_id) DO UPDATE SET
+                cache_key=$2, file_id=$3, data=$4, created_at=NOW()
+        """, user_id, cache_key, file_id, data)
@@ -1,26 +1,48 @@
 #scheduler.py
+from datetime import datetime
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 import pytz
-from db import get_db
+from db import acquire
+from user_cache import invalidate_user
+from broadcast import Broadcaster
 import os
 
 TIMEZONE = pytz.timezone(os.getenv("TIMEZONE", "Europe/Moscow"))
 scheduler = AsyncIOScheduler(timezone=TIMEZONE)
 
-#Напоминание о тренировке
-async def send_training_reminder(bot, user_id: int):
-    await bot.send_message(
-        user_id,
-        "🏋️ **Тренировка сегодня!**\nНе забудьте выполнить вашу сессию. Удачи!"
-    )
+DAYS_MAP = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
+
+REMINDER_TEXTS = {
+    #Напоминание о тренировке
+    "training": "🏋️ **Тренировка сегодня!**\nНе забудьте выполнить вашу сессию. Удачи!",
+    #Напоминание о взвешивании
+    "weight": "⚖️ Пожалуйста, введите ваш вес за сегодня.",
+}
+
+#Очередь рассылки, создаётся при запуске диспетчера
+broadcaster: Broadcaster | None = None
+
+
+def normalize_days(days_str: str) -> str:
+    """
+    Приводит расписание к виду 'mon,wed,fri'; 'daily' — все дни недели.
+    """
+    if days_str.strip().lower() == "daily":
+        return ",".join(DAYS_MAP)
+    days = [day.strip().lower() for day in days_str.split(",")]
+    return ",".join(day for day in DAYS_MAP if day in days)
+
+
+#Слоты (день недели, час, минута, вид) для расписания пользователя
+def reminder_slots(days_str: str, hour: int, minute: int) -> list:
+    slots = []
+    for day in days_str.split(","):
+        if day in DAYS_MAP:
+            slots.append((DAYS_MAP[day], hour, minute, "training"))
+            slots.append((DAYS_MAP[day], hour-1 if hour>0 else 0, minute, "weight"))
+    return slots
 
-#Напоминание о взвешивании
-async def send_weight_reminder(bot, user_id: int):
-    await bot.send_message(
-        user_id,
-        "⚖️ Пожалуйста, введите ваш вес за сегодня."
-    )
 
 #Настройка напоминаний пользователя
 async def setup_user_reminders(bot, user_id: int, days_str: str, hour: int = 18, minute: int = 0):
@@ -28,27 +50,71 @@ async def setup_user_reminders(bot, user_id: int, days_str: str, hour: int = 18,
     Настройка напоминаний о тренировках на выбранные дни и время.
     days_str: 'mon,wed,fri'
     hour, minute: время напоминания
+    Расписание хранится в БД (reminders + reminder_slots) и переживает перезапуск бота;
+    рассылку выполняет общий диспетчер, отдельные задачи планировщика не создаются.
     """
-    #Удаляем старые задачи пользователя
-    for job in scheduler.get_jobs():
-        if str(user_id) in job.id:
-            scheduler.remove_job(job.id)
-
-    days_map = {"mon":0, "tue":1, "wed":2, "thu":3, "fri":4, "sat":5, "sun":6}
+    days_str = normalize_days(days_str)
+    slots = reminder_slots(days_str, hour, minute)
 
-    for day in days_str.split(","):
-        if day in days_map:
-            # Тренировка
-            scheduler.add_job(
-                send_training_reminder,
-                CronTrigger(day_of_week=days_map[day], hour=hour, minute=minute, timezone=TIMEZONE),
-                args=[bot, user_id],
-                id=f"training_{user_id}_{day}"
-            )
-            # Напоминание о весе
-            scheduler.add_job(
-                send_weight_reminder,
-                CronTrigger(day_of_week=days_map[day], hour=hour-1 if hour>0 else 0, minute=minute, timezone=TIMEZONE),
-                args=[bot, user_id],
-                id=f"weight_{user_id}_{day}"
+    async with acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO reminders (telegram_id, days, hour, minute, timezone)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (telegram_id) DO UPDATE SET
+                    days=$2, hour=$3, minute=$4, timezone=$5, updated_at=NOW()
+            """, user_id, days_str, hour, minute, TIMEZONE.zone)
+            await conn.execute(
+                "UPDATE users SET next_reminder_days=$1, is_active=TRUE WHERE telegram_id=$2", days_str, user_id
             )
+            await conn.execute("DELETE FROM reminder_slots WHERE telegram_id=$1", user_id)
+            await conn.executemany("""
+                INSERT INTO reminder_slots (telegram_id, weekday, hour, minute, kind)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT DO NOTHING
+            """, [(user_id, *slot) for slot in slots])
+    invalidate_user(user_id)
+
+
+#Рассылка напоминаний, наступивших в текущую минуту
+async def dispatch_due_reminders(bot):
+    """
+    Выполняется раз в минуту: находит по индексу (weekday, hour, minute)
+    всех активных пользователей, кому пора напомнить, и ставит сообщения в очередь рассылки.
+    """
+    now = datetime.now(TIMEZONE)
+    async with acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT s.telegram_id, s.kind FROM reminder_slots s
+            JOIN users u ON u.telegram_id = s.telegram_id
+            WHERE s.weekday=$1 AND s.hour=$2 AND s.minute=$3 AND u.is_active
+        """, now.weekday(), now.hour, now.minute)
+
+    for row in rows:
+        broadcaster.enqueue(row['telegram_id'], REMINDER_TEXTS[row['kind']])
+
+
+#Запуск диспетчера напоминаний
+def start_reminder_dispatcher(bot):
+    """
+    Регистрирует единственную ежеминутную задачу вместо задач на каждого пользователя.
+    """
+    global broadcaster
+    broadcaster = Broadcaster(bot)
+    broadcaster.start()
+    scheduler.add_job(
+        dispatch_due_reminders,
+        CronTrigger(minute="*", timezone=TIMEZONE),
+        args=[bot],
+        id="reminder_dispatcher",
+        replace_existing=True,
+        coalesce=True,
+        max_instances=1,
+        misfire_grace_time=30,
+    )
+
+
+#Остановка рассылки с дожиданием уже поставленных сообщений
+async def stop_reminder_dispatcher(drain_timeout: float | None = None):
+    if broadcaster is not None:
+        await broadcaster.stop(timeout=drain_timeout)
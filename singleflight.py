@@ -0,0 +1,72 @@
+# singleflight.py
+import asyncio
+import functools
+import os
+import time
+
+#Сколько секунд после завершения повторный запрос считается дубликатом
+SINGLE_FLIGHT_WINDOW = float(os.getenv("SINGLE_FLIGHT_WINDOW", "3"))
+
+
+class SingleFlight:
+    """
+    Подавление повторных запросов: пока задача с ключом выполняется
+    и ещё window секунд после её успешного завершения, ключ считается занятым.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._inflight = set()
+        self._cooldown = {}
+
+    def is_busy(self, key) -> bool:
+        if key in self._inflight:
+            return True
+        until = self._cooldown.get(key)
+        return until is not None and until > time.monotonic()
+
+    async def do(self, key, func, *args, **kwargs):
+        """
+        Выполняет func, занимая ключ; после ошибки повторить можно сразу.
+        """
+        self._inflight.add(key)
+        try:
+            result = await func(*args, **kwargs)
+        finally:
+            self._inflight.discard(key)
+        self._hold(key)
+        return result
+
+    def _hold(self, key):
+        until = time.monotonic() + self.window
+        self._cooldown[key] = until
+        asyncio.get_running_loop().call_later(self.window, self._release, key, until)
+
+    def _release(self, key, until):
+        if self._cooldown.get(key) == until:
+            del self._cooldown[key]
+
+
+inflight = SingleFlight(SINGLE_FLIGHT_WINDOW)
+
+
+#Для CallbackQuery это всплывающее уведомление, для Message — ответное сообщение
+async def _notify_duplicate(event):
+    await event.answer("⏳ Запрос уже обрабатывается, подождите.")
+
+
+def single_flight(action: str):
+    """
+    Декоратор обработчика: пока действие action пользователя выполняется
+    (и ещё SINGLE_FLIGHT_WINDOW секунд после), повторные нажатия не запускают его снова.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(event, *args, **kwargs):
+            key = (event.from_user.id, action)
+            if inflight.is_busy(key):
+                await _notify_duplicate(event)
+                return
+            await inflight.do(key, handler, event, *args, **kwargs)
+        return wrapper
+    return decorator
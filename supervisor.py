@@ -0,0 +1,147 @@
+# supervisor.py
+"""
+Многопроцессный запуск бота: супервизор получает апдейты через long polling
+и раздаёт их воркерам по telegram_id, так что апдейты одного пользователя
+всегда обрабатываются одним процессом и по порядку.
+
+Запуск: python supervisor.py (число воркеров — SHARD_WORKERS).
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+
+from aiogram.types import Update
+
+from bot import bot, dp
+
+logger = logging.getLogger(__name__)
+
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 1)))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "30"))
+#Воркеры запускаются через spawn: перезапуск идёт из работающего цикла событий супервизора,
+#и fork унаследовал бы его открытую aiohttp-сессию бота и потоки
+MP_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def user_key(update: Update) -> int:
+    """
+    Ключ шардирования: id автора апдейта, для апдейтов без автора — update_id.
+    """
+    user = getattr(update.event, "from_user", None)
+    return user.id if user else update.update_id
+
+
+#Воркер
+async def _process(key: int, raw: dict, locks: dict, pending: dict):
+    #asyncio.Lock выдаётся в порядке очереди — апдейты пользователя идут строго друг за другом
+    try:
+        async with locks[key]:
+            await dp.feed_raw_update(bot, raw)
+    except Exception as e:
+        logger.exception("Ошибка обработки апдейта пользователя %s: %s", key, e)
+    finally:
+        pending[key] -= 1
+        if not pending[key]:
+            del pending[key]
+            del locks[key]
+
+
+async def _worker_main(queue):
+    loop = asyncio.get_running_loop()
+    #Владельца планировщика среди воркеров выбирает advisory-блокировка
+    dp["run_scheduler"] = None
+    await dp.emit_startup(bot=bot, dispatcher=dp, **dp.workflow_data)
+
+    locks, pending, tasks = {}, {}, set()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            key, raw = item
+            if key not in locks:
+                locks[key] = asyncio.Lock()
+            pending[key] = pending.get(key, 0) + 1
+            task = asyncio.create_task(_process(key, raw, locks, pending))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, **dp.workflow_data)
+        await bot.session.close()
+
+
+def run_worker(queue):
+    #Останавливаемся только по сигналу супервизора, дообработав очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_worker_main(queue))
+
+
+#Супервизор
+def _start_worker(index: int, queue) -> multiprocessing.Process:
+    worker = MP_CONTEXT.Process(target=run_worker, args=(queue,), name=f"shard-{index}")
+    worker.start()
+    return worker
+
+
+#Упавший воркер перезапускается на той же очереди — шард не теряет апдейты
+def _revive(workers: list, queues: list):
+    for index, worker in enumerate(workers):
+        if not worker.is_alive():
+            logger.warning("Воркер %s завершился с кодом %s, перезапускаем", worker.name, worker.exitcode)
+            workers[index] = _start_worker(index, queues[index])
+
+
+async def _poll(workers: list, queues: list):
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates
+                )
+            except Exception as e:
+                logger.warning("Ошибка получения апдейтов: %s", e)
+                await asyncio.sleep(1)
+                continue
+
+            _revive(workers, queues)
+            for update in updates:
+                key = user_key(update)
+                queues[key % len(queues)].put((key, update.model_dump(mode="json", by_alias=True, exclude_none=True)))
+                offset = update.update_id + 1
+    finally:
+        await bot.session.close()
+
+
+async def _supervise(workers: list, queues: list):
+    task = asyncio.create_task(_poll(workers, queues))
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def main():
+    queues = [MP_CONTEXT.Queue() for _ in range(SHARD_WORKERS)]
+    workers = [_start_worker(index, queue) for index, queue in enumerate(queues)]
+
+    try:
+        asyncio.run(_supervise(workers, queues))
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
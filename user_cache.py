@@ -0,0 +1,195 @@
+# user_cache.py
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, fields
+from datetime import datetime
+
+import asyncpg
+
+from db import acquire
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "50000"))
+#Срок жизни — страховка на случай потерянного уведомления об инвалидации
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "60"))
+#Канал LISTEN/NOTIFY: инвалидация доходит до всех процессов бота
+USER_CACHE_CHANNEL = "user_cache_invalidate"
+
+
+@dataclass(slots=True)
+class UserProfile:
+    """
+    Профиль пользователя без тяжёлых данных (текст плана хранится в plans).
+    Поддерживает доступ как к записи asyncpg: profile['goal'], profile.get('goal').
+    """
+    telegram_id: int
+    username: str | None
+    full_name: str
+    height: int
+    weight: float
+    goal: str
+    fitness_score: int | None
+    coaching_mode: str | None
+    workout_streak: int | None
+    last_workout_date: datetime | None
+    last_export: datetime | None
+    is_active: bool | None
+
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+#Узкая проекция вместо SELECT *
+PROFILE_COLUMNS = ", ".join(field.name for field in fields(UserProfile))
+
+#Отличает «пользователя нет» (тоже кэшируется) от промаха кэша
+_MISSING = object()
+
+
+class UserCache:
+    """
+    LRU-кэш профилей с TTL. Обработчики, меняющие users, вызывают invalidate().
+    """
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        #Выключен, пока нет подписки на инвалидации других процессов
+        self.enabled = False
+        self._entries = OrderedDict()
+        #Растёт при каждой инвалидации: результат чтения, начатого до записи, не кэшируется
+        self.generation = 0
+
+    def get(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return _MISSING
+        expires_at, profile = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            return _MISSING
+        self._entries.move_to_end(user_id)
+        return profile
+
+    def set(self, user_id: int, profile: UserProfile | None):
+        self._entries[user_id] = (time.monotonic() + self.ttl, profile)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self.generation += 1
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+
+user_cache = UserCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL)
+
+
+async def get_user(user_id: int) -> UserProfile | None:
+    """
+    Профиль из кэша, при промахе — одним узким запросом к БД.
+    None — пользователь не зарегистрирован.
+    """
+    profile = user_cache.get(user_id) if user_cache.enabled else _MISSING
+    if profile is not _MISSING:
+        return profile
+
+    generation = user_cache.generation
+    async with acquire() as conn:
+        row = await conn.fetchrow(f"SELECT {PROFILE_COLUMNS} FROM users WHERE telegram_id=$1", user_id)
+    profile = UserProfile(**dict(row)) if row else None
+    if user_cache.enabled and generation == user_cache.generation:
+        user_cache.set(user_id, profile)
+    return profile
+
+
+#Отправленные, но ещё не выполненные NOTIFY
+_notify_tasks = set()
+
+
+def invalidate_user(user_id: int):
+    """
+    Сбрасывает профиль в своём процессе и через NOTIFY — в остальных.
+    """
+    user_cache.invalidate(user_id)
+    if _listener_conn is not None:
+        task = asyncio.get_running_loop().create_task(_notify(user_id))
+        _notify_tasks.add(task)
+        task.add_done_callback(_notify_tasks.discard)
+
+
+async def _notify(user_id: int):
+    try:
+        async with acquire() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", USER_CACHE_CHANNEL, str(user_id))
+    except Exception as e:
+        logger.warning("user_cache: не удалось разослать инвалидацию %s: %s", user_id, e)
+
+
+#Подписка на инвалидации на отдельном соединении (как у acquire_leadership)
+_listener_conn: asyncpg.Connection | None = None
+_reconnect_task: asyncio.Task | None = None
+
+
+def _on_invalidate(conn, pid, channel, payload):
+    user_cache.invalidate(int(payload))
+
+
+def _on_listener_lost(conn):
+    #Без подписки кэш мог бы отдавать чужие устаревшие данные — выключаем его до переподключения
+    global _listener_conn, _reconnect_task
+    _listener_conn = None
+    user_cache.enabled = False
+    user_cache.clear()
+    logger.warning("user_cache: соединение LISTEN потеряно, кэш профилей выключен")
+    _reconnect_task = asyncio.get_running_loop().create_task(start_invalidation_listener(retry_delay=5))
+
+
+async def start_invalidation_listener(retry_delay: float = 0):
+    """
+    Подписывается на канал инвалидаций и включает кэш. retry_delay > 0 — повторять до успеха.
+    """
+    global _listener_conn
+    while _listener_conn is None:
+        if retry_delay:
+            await asyncio.sleep(retry_delay)
+        try:
+            conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+            await conn.add_listener(USER_CACHE_CHANNEL, _on_invalidate)
+        except Exception as e:
+            if not retry_delay:
+                raise
+            logger.warning("user_cache: не удалось подписаться на инвалидации: %s", e)
+            continue
+        conn.add_termination_listener(_on_listener_lost)
+        _listener_conn = conn
+        #Пока подписки не было, изменения других процессов могли пройти мимо
+        user_cache.clear()
+        user_cache.enabled = True
+
+
+async def stop_invalidation_listener():
+    global _listener_conn
+    user_cache.enabled = False
+    if _reconnect_task is not None:
+        _reconnect_task.cancel()
+    if _notify_tasks:
+        await asyncio.gather(*_notify_tasks, return_exceptions=True)
+    if _listener_conn is not None:
+        conn, _listener_conn = _listener_conn, None
+        conn.remove_termination_listener(_on_listener_lost)
+        await conn.close()
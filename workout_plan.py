@@ -0,0 +1,233 @@
+# workout_plan.py
+import html
+import json
+import re
+from dataclasses import dataclass, field, asdict, replace
+
+#Разделы плана и их заголовки в ответе LLM
+SECTION_TITLES = {
+    "warmup": "Разминка",
+    "exercises": "Основная часть",
+    "cooldown": "Заминка",
+    "nutrition": "Рекомендации по питанию на день",
+}
+
+_HEADINGS = (
+    ("разминка", "warmup"),
+    ("основная часть", "exercises"),
+    ("заминка", "cooldown"),
+    ("рекомендации по питанию", "nutrition"),
+    ("питание", "nutrition"),
+)
+_MACROS = (("белк", "protein"), ("углевод", "carbs"), ("жир", "fat"), ("калори", "calories"))
+_MACRO_TITLES = {"protein": "Белки", "carbs": "Углеводы", "fat": "Жиры", "calories": "Калории"}
+
+_ITEM_RE = re.compile(r"^(?:\d+[.)]|[-*•])\s+")
+#«Приседания (ноги) - 3x10-15», «Планка - 3 подхода по 30-60 секунд»
+_EXERCISE_RE = re.compile(
+    r"^(?P<name>.+?)\s*(?:\((?P<muscle>[^()]*)\))?\s*[-–—:]\s*"
+    r"(?P<sets>\d+)\s*(?:[xхXХ×*]|подход\w*\s*(?:по)?)\s*(?P<reps>.+)$"
+)
+
+
+@dataclass(slots=True)
+class Exercise:
+    name: str
+    muscle_group: str = ""
+    sets: int | None = None
+    reps: str = ""
+
+    @property
+    def volume(self) -> str:
+        return f"{self.sets}x{self.reps}" if self.sets else self.reps
+
+    def line(self) -> str:
+        text = self.name
+        if self.muscle_group:
+            text += f" ({self.muscle_group})"
+        if self.volume:
+            text += f" - {self.volume}"
+        return text
+
+
+@dataclass(slots=True)
+class Nutrition:
+    protein: str = ""
+    carbs: str = ""
+    fat: str = ""
+    calories: str = ""
+    meals: list[str] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class WorkoutPlan:
+    """
+    Структурированная дневная тренировка.
+    profile — отпечаток анкеты (plan_profile), для которой составлен план.
+    """
+    title: str = ""
+    warmup: list[str] = field(default_factory=list)
+    exercises: list[Exercise] = field(default_factory=list)
+    cooldown: list[str] = field(default_factory=list)
+    nutrition: Nutrition = field(default_factory=Nutrition)
+    notes: list[str] = field(default_factory=list)
+    profile: str = ""
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, raw: str) -> "WorkoutPlan":
+        data = json.loads(raw)
+        data["exercises"] = [Exercise(**exercise) for exercise in data.get("exercises", [])]
+        data["nutrition"] = Nutrition(**data.get("nutrition", {}))
+        return cls(**data)
+
+    def with_section(self, section: str, other: "WorkoutPlan") -> "WorkoutPlan":
+        """
+        Копия плана, в которой раздел section взят из other.
+        """
+        return replace(self, **{section: getattr(other, section)})
+
+    def render(self, as_html: bool = True) -> str:
+        """
+        Текст плана для отправки (HTML) или для промпта (as_html=False, в формате ответа LLM).
+        """
+        escape = html.escape if as_html else str
+
+        def heading(text: str) -> str:
+            return f"<b>{escape(text)}:</b>" if as_html else f"**{text}:**"
+
+        parts = []
+        if self.title:
+            parts.append(f"<b>{escape(self.title)}</b>" if as_html else self.title)
+        if self.warmup:
+            parts.append("\n".join([heading(SECTION_TITLES["warmup"])] + [f"- {escape(item)}" for item in self.warmup]))
+        if self.exercises:
+            lines = [f"{number}. {escape(exercise.line())}" for number, exercise in enumerate(self.exercises, start=1)]
+            parts.append("\n".join([heading(SECTION_TITLES["exercises"])] + lines))
+        if self.cooldown:
+            parts.append("\n".join([heading(SECTION_TITLES["cooldown"])] + [f"- {escape(item)}" for item in self.cooldown]))
+
+        nutrition = [
+            f"- {title}: {escape(getattr(self.nutrition, key))}"
+            for key, title in _MACRO_TITLES.items() if getattr(self.nutrition, key)
+        ] + [f"- {escape(meal)}" for meal in self.nutrition.meals]
+        if nutrition:
+            parts.append("\n".join([heading(SECTION_TITLES["nutrition"])] + nutrition))
+
+        if self.notes:
+            parts.append("\n".join(escape(note) for note in self.notes))
+        return "\n\n".join(parts)
+
+
+def plan_profile(user_data: dict) -> str:
+    """
+    Отпечаток анкеты: пока он не меняется, разминку, заминку и питание можно не генерировать заново.
+    """
+    return f"{user_data['goal']}|{round(user_data['weight'])}|{user_data.get('coaching_mode') or 'level1'}"
+
+
+def _heading_section(line: str) -> str | None:
+    lowered = line.strip("*#: ").lower()
+    for prefix, section in _HEADINGS:
+        if lowered.startswith(prefix):
+            return section
+    return None
+
+
+def _parse_exercise(text: str) -> Exercise:
+    match = _EXERCISE_RE.match(text)
+    if not match:
+        return Exercise(name=text)
+    return Exercise(
+        name=match["name"].strip(),
+        muscle_group=(match["muscle"] or "").strip(),
+        sets=int(match["sets"]),
+        reps=match["reps"].strip(),
+    )
+
+
+def _add_nutrition_line(nutrition: Nutrition, text: str):
+    lowered = text.lower()
+    for prefix, key in _MACROS:
+        if lowered.startswith(prefix) and ":" in text:
+            setattr(nutrition, key, text.split(":", 1)[1].strip())
+            return
+    #Подзаголовок «Пример приемов пищи» сам по себе не нужен
+    if lowered.startswith("пример") and not text.split(":", 1)[-1].strip():
+        return
+    if lowered.startswith("пример"):
+        text = text.split(":", 1)[1].strip()
+    nutrition.meals.append(text)
+
+
+def _read_plan(text: str, profile: str = "") -> WorkoutPlan:
+    plan = WorkoutPlan(profile=profile)
+    section = None
+    for raw_line in text.splitlines():
+        line = raw_line.replace("**", "").replace("__", "").strip()
+        if not line:
+            continue
+        item = _ITEM_RE.match(line)
+        if not item:
+            heading = _heading_section(line)
+            if heading:
+                section = heading
+                continue
+            if section is None and not plan.title:
+                plan.title = line.strip("#* ")
+                continue
+
+        content = line[item.end():].strip() if item else line
+        if section == "nutrition" and (item or ":" in content):
+            _add_nutrition_line(plan.nutrition, content)
+        elif not item:
+            plan.notes.append(content)
+        elif section == "warmup":
+            plan.warmup.append(content)
+        elif section == "exercises":
+            plan.exercises.append(_parse_exercise(content))
+        elif section == "cooldown":
+            plan.cooldown.append(content)
+        else:
+            plan.notes.append(content)
+    return plan
+
+
+def parse_plan(text: str, profile: str = "") -> WorkoutPlan | None:
+    """
+    Разбирает ответ LLM в формате PLAN_FORMAT. None — в ответе не нашлось упражнений основной части.
+    """
+    plan = _read_plan(text, profile)
+    return plan if plan.exercises else None
+
+
+def parse_section(text: str, section: str) -> WorkoutPlan | None:
+    """
+    Разбирает ответ с одним разделом плана; заголовок раздела модель может опустить.
+    """
+    plan = _read_plan(f"**{SECTION_TITLES[section]}:**\n{text}")
+    content = getattr(plan, section)
+    if isinstance(content, Nutrition):
+        content = any(asdict(content).values())
+    return plan if content else None
+
+
+def diff_plans(previous: WorkoutPlan, current: WorkoutPlan) -> list[str]:
+    """
+    Отличия упражнений основной части: «+ новое», «− убранное», «~ изменён объём».
+    """
+    before = {exercise.name.lower(): exercise for exercise in previous.exercises}
+    after = {exercise.name.lower(): exercise for exercise in current.exercises}
+    lines = []
+    for key, exercise in after.items():
+        old = before.get(key)
+        if old is None:
+            lines.append(f"+ {exercise.name}")
+        elif old.volume != exercise.volume:
+            lines.append(f"~ {exercise.name}: {old.volume} → {exercise.volume}")
+    lines += [f"− {exercise.name}" for key, exercise in before.items() if key not in after]
+    if asdict(previous.nutrition) != asdict(current.nutrition):
+        lines.append("~ Рекомендации по питанию обновлены")
+    return lines